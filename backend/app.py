@@ -1,11 +1,20 @@
-import os, json, uuid
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import os, io, json, uuid
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from models import PlanOpsRequest, ApplyOpsRequest, CreateDocRequest, Operation, OutlineItem
-from doc_ops import create_document, apply_operations, build_outline, load_outline, redline_compare, list_versions, load_doc
-from preview import convert_docx_to_html
+from pydantic import ValidationError
+from models import PlanOpsRequest, ApplyOpsRequest, CreateDocRequest, Operation, OutlineItem, AnchorReconcileRequest, JobRequest, RedlineJobParams, PreviewJobParams
+from doc_ops import create_document, apply_operations, build_outline, load_outline, redline_compare, list_versions, load_doc, current_version, outline_delta, load_block_index, load_oplog, rebuild_version, undo, redo, reconcile_anchors, ReplayDriftError
+from op_planner import PlanConflictError
+import search_index
+import storage
+import templates
+import jobs
+import wire
+from preview import convert_docx_to_html, convert_docx_window, section_range
 import re
 from dotenv import load_dotenv
 
@@ -16,7 +25,13 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")  # Optional: for custom endpoints
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
 
-app = FastAPI(title="Docx Agent MVP v2")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    jobs.start()
+    yield
+    jobs.stop()
+
+app = FastAPI(title="Docx Agent MVP v2", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,73 +42,190 @@ app.add_middleware(
 )
 
 BASE_DIR = os.path.dirname(__file__)
-STORAGE_DIR = os.environ.get("STORAGE_DIR", os.path.join(BASE_DIR, "..", "storage"))
+STORAGE_DIR = storage.STORAGE_DIR
 FRONTEND_DIR = os.path.join(BASE_DIR, "..", "frontend", "dist")
 
-os.makedirs(STORAGE_DIR, exist_ok=True)
+# Move documents from the old flat layout into sharded dirs + catalog (no-op once migrated)
+storage.migrate_flat_store()
 
 # Serve built frontend (Vite build outputs to dist/)
 if os.path.exists(FRONTEND_DIR):
     app.mount("/", StaticFiles(directory=FRONTEND_DIR, html=True), name="frontend")
 
 def _file_path(file_id: str) -> str:
-    return os.path.join(STORAGE_DIR, f"{file_id}.docx")
+    return storage.file_path(file_id)
 
 @app.post("/api/create")
 async def create_doc(req: CreateDocRequest):
-    fid = create_document(req.title, req.body)
+    try:
+        fid = create_document(req.title, req.body, req.template_id)
+    except FileNotFoundError as e:
+        raise HTTPException(404, str(e))
     return {"file_id": fid, "download_url": f"/api/download/{fid}"}
 
+@app.post("/api/templates")
+async def register_template(template_id: str = Form(...), file: UploadFile = File(...)):
+    """Register a custom .docx/.dotx template for /api/create (replaces one with the same id)."""
+    if not file.filename.lower().endswith((".docx", ".dotx")):
+        raise HTTPException(status_code=400, detail="Upload a .docx or .dotx")
+    try:
+        templates.register_template(template_id, await file.read())
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"template_id": template_id}
+
+@app.get("/api/templates")
+async def list_templates():
+    return {"templates": templates.list_templates()}
+
 @app.post("/api/upload")
 async def upload(file: UploadFile = File(...)):
     if not file.filename.lower().endswith(".docx"):
         raise HTTPException(status_code=400, detail="Upload a .docx")
     fid = str(uuid.uuid4())
+    storage.ensure_doc_dir(fid)
     path = _file_path(fid)
     with open(path, "wb") as f:
         f.write(await file.read())
     # initial outline and first version
-    from doc_ops import save_version, build_outline
-    build_outline(fid)  # also persisted in save_version path during create? ensure outline exists
+    from doc_ops import save_version, build_outline, write_outline
+    write_outline(fid, build_outline(fid))
     save_version(fid, path)
     return {"file_id": fid, "download_url": f"/api/download/{fid}"}
 
 @app.get("/api/download/{file_id}")
-async def download(file_id: str):
+async def download(file_id: str, version: Optional[int] = None):
     path = _file_path(file_id)
     if not os.path.exists(path): raise HTTPException(404, "Not found")
+    if version is not None and version != current_version(file_id):
+        # point-in-time rebuild from the nearest checkpoint
+        try:
+            doc = rebuild_version(file_id, version)
+        except FileNotFoundError as e:
+            raise HTTPException(404, str(e))
+        except ReplayDriftError as e:
+            raise HTTPException(409, str(e))
+        buf = io.BytesIO()
+        doc.save(buf)
+        return Response(buf.getvalue(), media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                        headers={"Content-Disposition": f'attachment; filename="{file_id}-v{version}.docx"'})
     return FileResponse(path, filename=f"{file_id}.docx", media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
 
+def _preview_payload(file_id: str, offset: Optional[int], limit: Optional[int], section: Optional[str], progress=None) -> dict:
+    if progress:
+        progress(0.0, "loading")
+    doc = load_doc(file_id)
+    if progress:
+        progress(0.2, "rendering")
+    if offset is None and limit is None and section is None:
+        return {"html": convert_docx_to_html(doc)}
+
+    index = load_block_index(file_id, doc)
+    if section is not None:
+        rng = section_range(index, section)
+        if rng is None:
+            raise HTTPException(404, f"section {section} not found")
+        start, end = rng
+    else:
+        start = max(0, offset or 0)
+        end = start + (limit if limit is not None else 200)
+    end = min(end, len(index))
+    return {
+        "html": convert_docx_window(doc, index, start, end),
+        "offset": start,
+        "limit": end - start,
+        "total_blocks": len(index),
+        "total_paragraphs": sum(1 for b in index if b[0] == "p"),
+        "headings": [[i, b[1], b[2]] for i, b in enumerate(index) if b[1] > 0],
+    }
+
 @app.get("/api/preview/{file_id}")
-async def preview_html(file_id: str):
-    """Convert docx to HTML with proper numbering support"""
+async def preview_html(file_id: str, request: Request, offset: Optional[int] = None, limit: Optional[int] = None, section: Optional[str] = None):
+    """Convert docx to HTML with proper numbering support.
+
+    With `offset`/`limit` (blocks) or `section` (a heading paragraph_id) only
+    that window is rendered, along with block counts and heading positions.
+    """
     try:
-        doc = load_doc(file_id)
-        html_content = convert_docx_to_html(doc)
-        return JSONResponse({"html": html_content})
+        return wire.respond(request, _preview_payload(file_id, offset, limit, section))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, str(e))
 
 @app.get("/api/outline/{file_id}")
-async def outline(file_id: str):
+async def outline(file_id: str, request: Request, format: Literal["items", "columns"] = "items", text_limit: Optional[int] = Query(None, ge=0)):
+    """Outline as a list of items or, with format=columns, as parallel arrays (see wire.py)."""
     try:
         outline = load_outline(file_id)
-        return [o.__dict__ for o in outline]
     except Exception as e:
         raise HTTPException(404, str(e))
+    return wire.respond(request, wire.format_outline(outline, format, text_limit))
+
+@app.get("/api/outline/{file_id}/delta")
+async def outline_changes(file_id: str, request: Request, since: int, until: Optional[int] = None):
+    """Outline changes between two stored versions (defaults to the latest)."""
+    try:
+        return wire.respond(request, outline_delta(file_id, since, until))
+    except FileNotFoundError as e:
+        raise HTTPException(404, str(e))
+    except ReplayDriftError as e:
+        raise HTTPException(409, str(e))
+
+@app.post("/api/anchors/reconcile")
+async def anchors_reconcile(req: AnchorReconcileRequest, request: Request):
+    """Canonical paragraph IDs for the Word add-in's paragraphs, plus anchors to add/drop."""
+    if not os.path.exists(_file_path(req.file_id)):
+        raise HTTPException(404, "Not found")
+    return wire.respond(request, reconcile_anchors(req.file_id, req.paragraphs, req.anchors))
+
+@app.get("/api/search")
+async def search(q: str, file_id: Optional[str] = None, limit: int = 20):
+    """Paragraphs across stored documents matching all terms of `q`."""
+    return {"results": search_index.search(q, file_id=file_id, limit=max(1, min(limit, 200)))}
 
 @app.get("/api/versions/{file_id}")
 async def versions(file_id: str):
-    return {"versions": list_versions(file_id)}
+    return {"versions": list_versions(file_id), "current": current_version(file_id)}
+
+@app.get("/api/oplog/{file_id}")
+async def oplog(file_id: str):
+    """Operations that produced each version, oldest first."""
+    return {"entries": [e for _, e in sorted(load_oplog(file_id).items())], "current": current_version(file_id)}
+
+# undo/redo/apply-ops are plain defs: they wait on the document lock, so they run
+# in the threadpool rather than on the event loop
+@app.post("/api/undo/{file_id}")
+def undo_op(file_id: str):
+    try:
+        version = undo(file_id)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except ReplayDriftError as e:
+        raise HTTPException(409, str(e))
+    return {"file_id": file_id, "version": version, "download_url": f"/api/download/{file_id}"}
+
+@app.post("/api/redo/{file_id}")
+def redo_op(file_id: str):
+    try:
+        version = redo(file_id)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except ReplayDriftError as e:
+        raise HTTPException(409, str(e))
+    return {"file_id": file_id, "version": version, "download_url": f"/api/download/{file_id}"}
 
 @app.get("/api/redline")
 async def redline(base_id: str, revised_id: str):
     try:
-        out_id = redline_compare(base_id, revised_id)
-        return {"file_id": out_id, "download_url": f"/api/download/{out_id}"}
+        return _redline_payload(base_id, revised_id)
     except Exception as e:
         raise HTTPException(500, str(e))
 
+def _redline_payload(base_id: str, revised_id: str, progress=None) -> dict:
+    out_id = redline_compare(base_id, revised_id, progress)
+    return {"file_id": out_id, "download_url": f"/api/download/{out_id}"}
+
 @app.post("/api/plan-ops")
 async def plan_ops(req: PlanOpsRequest):
     instruction = req.instruction.strip()
@@ -156,7 +288,7 @@ async def plan_ops(req: PlanOpsRequest):
         outline_json = []
         if req.file_id:
             try:
-                outline_json = [o for o in (await outline(req.file_id))]  # reuse handler (sync call in same process is fine)
+                outline_json = wire.outline_items(load_outline(req.file_id))
             except Exception:
                 pass
 
@@ -260,7 +392,72 @@ Return ONLY valid JSON, no other text."""
         return JSONResponse({"operations": [], "error": str(e), "detail": error_detail}, status_code=500)
 
 @app.post("/api/apply-ops")
-async def apply_ops(req: ApplyOpsRequest):
-    from doc_ops import apply_operations
-    new_id, outline = apply_operations(req.file_id, [Operation(**op) if isinstance(op, dict) else op for op in req.operations])
-    return {"file_id": new_id, "download_url": f"/api/download/{new_id}", "outline": [o.__dict__ for o in outline]}
+def apply_ops(req: ApplyOpsRequest, request: Request):
+    try:
+        return wire.respond(request, _apply_payload(req))
+    except PlanConflictError as e:
+        raise HTTPException(400, str(e))
+
+def _apply_payload(req: ApplyOpsRequest, progress=None) -> dict:
+    from doc_ops import apply_operations, dry_run_operations
+    operations = [Operation(**op) if isinstance(op, dict) else op for op in req.operations]
+    if req.dry_run:
+        result = dry_run_operations(req.file_id, operations, with_preview=req.preview)
+        result["outline"] = wire.format_outline(result["outline"], req.outline_format, req.text_limit)
+        return result
+    with storage.document_lock(req.file_id):
+        base_version = current_version(req.file_id)
+        new_id, outline, report = apply_operations(req.file_id, operations, progress)
+        resp = {"file_id": new_id, "download_url": f"/api/download/{new_id}", "version": current_version(new_id), "plan": report}
+    if req.return_delta and base_version:
+        resp["outline_delta"] = outline_delta(new_id, base_version, resp["version"])
+    else:
+        resp["outline"] = wire.format_outline(outline, req.outline_format, req.text_limit)
+    return resp
+
+# --------- Background jobs ---------
+_JOB_PARAMS = {"redline": RedlineJobParams, "apply_ops": ApplyOpsRequest, "preview": PreviewJobParams}
+
+jobs.register("redline", lambda params, progress: _redline_payload(**params, progress=progress))
+# an interrupted apply may already have saved; don't run it a second time after a restart
+jobs.register("apply_ops", lambda params, progress: _apply_payload(ApplyOpsRequest(**params), progress), rerun_on_restart=False)
+jobs.register("preview", lambda params, progress: _preview_payload(**params, progress=progress))
+
+@app.post("/api/jobs")
+async def submit_job(req: JobRequest):
+    """Queue a redline, apply_ops or preview run; poll /api/jobs/{job_id} for progress."""
+    try:
+        params = _JOB_PARAMS[req.kind](**req.params)
+    except ValidationError as e:
+        raise HTTPException(400, str(e))
+    file_ids = [params.base_id, params.revised_id] if req.kind == "redline" else [params.file_id]
+    for fid in file_ids:
+        if not os.path.exists(_file_path(fid)):
+            raise HTTPException(404, f"file {fid} not found")
+    job_id = jobs.submit(req.kind, params.model_dump())
+    return {"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"}
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "job not found")
+    return job
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Queued jobs are cancelled at once; running ones stop at their next progress point."""
+    status = jobs.cancel(job_id)
+    if status is None:
+        raise HTTPException(404, "job not found")
+    return {"job_id": job_id, "status": status}
+
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    found = jobs.result(job_id)
+    if found is None:
+        raise HTTPException(404, "job not found")
+    status, result = found
+    if status != "done":
+        raise HTTPException(409, f"job is {status}")
+    return result
@@ -0,0 +1,29 @@
+"""
+Blank-document creation: python-docx's Document() vs the cached template clone,
+and end-to-end create_document throughput.
+
+Run from backend/:  STORAGE_DIR=/tmp/bench-storage python benchmarks/bench_create.py
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from docx import Document
+import templates
+import doc_ops
+
+N = 200
+
+
+def per_call(fn, n: int = N) -> float:
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n
+
+
+if __name__ == "__main__":
+    print(f"Document()             {per_call(Document) * 1000:6.2f} ms")
+    print(f"templates.new_document {per_call(templates.new_document) * 1000:6.2f} ms")
+    t = per_call(lambda: doc_ops.create_document("Title", "First\nSecond\nThird"), 50)
+    print(f"create_document        {t * 1000:6.2f} ms  ({1 / t:.0f} docs/s)")
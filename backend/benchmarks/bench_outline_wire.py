@@ -0,0 +1,63 @@
+"""
+Outline payload size and serialization time on a 20k-paragraph outline:
+the previous path (FastAPI's jsonable_encoder + json over item dicts, and the
+indent=2 outline file) vs wire.py's item/columnar layouts and encodings.
+
+Run from backend/:  python benchmarks/bench_outline_wire.py
+"""
+import os, sys, json, gzip, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi.encoders import jsonable_encoder
+from models import OutlineItem
+from utils import stable_paragraph_id
+import wire
+
+N_PARAS = 20000
+WORDS = "the contract party shall agreement section clause notice payment term period within days written consent".split()
+
+
+def build_outline():
+    rnd = random.Random(7)
+    outline = []
+    for i in range(N_PARAS):
+        level = rnd.choice([1, 2, 3]) if i % 25 == 0 else 0
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(4, 12) if level else rnd.randint(15, 60)))
+        outline.append(OutlineItem(paragraph_id=stable_paragraph_id(text, i, level), text=text, level=level))
+    return outline
+
+
+def timed(fn, repeat: int = 5):
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def row(label: str, fn):
+    t, body = timed(fn)
+    print(f"{label:<42} {len(body) / 1024:9.0f} KiB {t * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    outline = build_outline()
+    print(f"{N_PARAS} paragraphs; encoders: orjson={'yes' if wire.orjson else 'no'} "
+          f"brotli={'yes' if wire.brotli else 'no'} msgpack={'yes' if wire.msgpack else 'no'}")
+    print(f"{'payload':<42} {'size':>13} {'encode':>12}")
+
+    row("before: file, json indent=2", lambda: json.dumps([o.__dict__ for o in outline], ensure_ascii=False, indent=2).encode())
+    row("before: response, jsonable_encoder + json",
+        lambda: json.dumps(jsonable_encoder([o.__dict__ for o in outline]), ensure_ascii=False).encode())
+    row("items", lambda: wire.dumps(wire.outline_items(outline)))
+    row("columns", lambda: wire.dumps(wire.outline_columns(outline)))
+    row("columns, text_limit=80", lambda: wire.dumps(wire.outline_columns(outline, 80)))
+    row("items + gzip", lambda: wire.encode(wire.outline_items(outline), accept_encoding="gzip")[0])
+    row("columns + gzip", lambda: wire.encode(wire.outline_columns(outline), accept_encoding="gzip")[0])
+    row("columns, text_limit=80 + gzip", lambda: wire.encode(wire.outline_columns(outline, 80), accept_encoding="gzip")[0])
+    if wire.brotli is not None:
+        row("columns + br", lambda: wire.encode(wire.outline_columns(outline), accept_encoding="br")[0])
+    if wire.msgpack is not None:
+        row("columns, msgpack", lambda: wire.encode(wire.outline_columns(outline), accept=wire.MSGPACK_TYPE)[0])
+        row("columns, msgpack + gzip", lambda: wire.encode(wire.outline_columns(outline), accept=wire.MSGPACK_TYPE, accept_encoding="gzip")[0])
@@ -0,0 +1,68 @@
+"""
+Preview time on a document with a heavy numbering part.
+
+Run from backend/:  python benchmarks/bench_preview_numbering.py
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+import preview
+
+N_ABSTRACT = 400
+N_NUMS = 2000
+N_PARAS = 5000
+FORMATS = ["decimal", "lowerLetter", "lowerRoman", "upperLetter", "upperRoman", "decimal", "lowerLetter", "lowerRoman", "bullet"]
+
+
+def build_doc() -> Document:
+    doc = Document()
+    numbering = doc.part.numbering_part.element
+    for a in range(N_ABSTRACT):
+        lvls = "".join(
+            f'<w:lvl w:ilvl="{i}"><w:start w:val="1"/><w:numFmt w:val="{FORMATS[i]}"/>'
+            f'<w:lvlText w:val="{".".join(f"%{k + 1}" for k in range(i + 1))}."/></w:lvl>'
+            for i in range(9))
+        numbering.append(parse_xml(f'<w:abstractNum {nsdecls("w")} w:abstractNumId="{1000 + a}">{lvls}</w:abstractNum>'))
+    for n in range(N_NUMS):
+        override = '<w:lvlOverride w:ilvl="0"><w:startOverride w:val="5"/></w:lvlOverride>' if n % 7 == 0 else ''
+        numbering.append(parse_xml(
+            f'<w:num {nsdecls("w")} w:numId="{1000 + n}"><w:abstractNumId w:val="{1000 + n % N_ABSTRACT}"/>{override}</w:num>'))
+    for i in range(N_PARAS):
+        p = doc.add_paragraph(f"Clause {i}")
+        p._p.get_or_add_pPr().append(parse_xml(
+            f'<w:numPr {nsdecls("w")}><w:ilvl w:val="{i % 3}"/><w:numId w:val="{1000 + (i // 50) % N_NUMS}"/></w:numPr>'))
+    return doc
+
+
+def timed(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == "__main__":
+    doc = build_doc()
+    print(f"numbering part: {len(doc.part.numbering_part.blob) / 1024:.0f} KiB, {N_PARAS} numbered paragraphs")
+
+    def cold():
+        preview._model_cache.clear()
+        preview.convert_docx_to_html(doc)
+
+    def warm():
+        preview.convert_docx_to_html(doc)
+
+    def parse_cold():
+        preview._model_cache.clear()
+        preview.DocxToHtmlConverter(doc)
+
+    def parse_warm():
+        preview.DocxToHtmlConverter(doc)
+
+    print(f"model setup  cold: {timed(parse_cold) * 1000:8.1f} ms   warm: {timed(parse_warm) * 1000:8.1f} ms")
+    print(f"full preview cold: {timed(cold) * 1000:8.1f} ms   warm: {timed(warm) * 1000:8.1f} ms")
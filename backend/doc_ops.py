@@ -1,45 +1,53 @@
-import os, json, uuid, difflib
-from typing import List, Tuple, Optional, Union
+import os, json, uuid, difflib, hashlib
+from xml.sax.saxutils import escape as xml_escape
+from typing import Callable, Dict, List, Tuple, Optional, Union
 from docx import Document
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
-from docx.shared import RGBColor
+from lxml import etree
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import qn, nsdecls
+from docx.shared import RGBColor, Emu
 from docx.enum.text import WD_UNDERLINE
+from docx.table import Table, _Cell
+from docx.text.paragraph import Paragraph
+from docx.enum.style import WD_STYLE_TYPE
 from models import Operation, OutlineItem
-from utils import stable_paragraph_id, normalize_text
-
-STORAGE_DIR = os.environ.get("STORAGE_DIR", os.path.join(os.path.dirname(__file__), "..", "storage"))
-os.makedirs(STORAGE_DIR, exist_ok=True)
-
-VERSIONS_DIR = os.path.join(STORAGE_DIR, "versions")
-os.makedirs(VERSIONS_DIR, exist_ok=True)
-
-def _file_path(file_id: str) -> str:
-    return os.path.join(STORAGE_DIR, f"{file_id}.docx")
-
-def _outline_path(file_id: str) -> str:
-    return os.path.join(STORAGE_DIR, f"{file_id}.outline.json")
+from op_planner import optimize_operations
+from preview import build_block_index, convert_docx_window
+import search_index
+import storage
+import wire
+from templates import new_document
+from utils import stable_paragraph_id, normalize_text, text_hash, heading_level as _heading_level, style_heading_level, style_level
+
+def write_outline(file_id: str, outline: List[OutlineItem]) -> None:
+    with open(storage.outline_path(file_id), "wb") as f:
+        f.write(wire.dumps(wire.outline_items(outline)))
+    # keep the catalog and the cross-document search index in step with the stored outline
+    storage.update_outline_meta(file_id, outline)
+    search_index.index_outline(file_id, outline)
 
 def save_new_doc(doc: Document) -> str:
     fid = str(uuid.uuid4())
-    path = _file_path(fid)
+    storage.ensure_doc_dir(fid)
+    path = storage.file_path(fid)
     doc.save(path)
-    # first outline
-    outline = build_outline(fid)
-    with open(_outline_path(fid), "w", encoding="utf-8") as f:
-        json.dump([o.__dict__ for o in outline], f, ensure_ascii=False, indent=2)
+    # first outline, straight from the in-memory document
+    stats = compute_style_stats(doc)
+    write_outline(fid, outline_from_doc(doc, stats["heading_styles"]))
     # version 1
-    save_version(fid, path)
+    vname = save_version(fid, path)
+    stats["version"] = int(vname[1:-5])
+    write_style_stats(fid, stats)
     return fid
 
 def load_doc(file_id: str) -> Document:
-    path = _file_path(file_id)
+    path = storage.file_path(file_id)
     if not os.path.exists(path):
         raise FileNotFoundError("file not found")
     return Document(path)
 
-def create_document(title: str, body: Optional[str]) -> str:
-    doc = Document()
+def create_document(title: str, body: Optional[str], template_id: Optional[str] = None) -> str:
+    doc = new_document(template_id)
     if title:
         doc.add_heading(title, 0)
     if body:
@@ -47,69 +55,114 @@ def create_document(title: str, body: Optional[str]) -> str:
             doc.add_paragraph(line)
     return save_new_doc(doc)
 
-def _heading_level(p) -> int:
-    try:
-        name = (p.style.name or "").lower()
-    except Exception:
-        name = ""
-    if name.startswith("heading"):
-        try:
-            parts = name.split()
-            lvl = int(parts[1]) if len(parts)>1 else 1
-            return max(1, min(6, lvl))
-        except Exception:
-            return 1
-    return 0
-
 def build_outline(file_id: str) -> List[OutlineItem]:
-    doc = load_doc(file_id)
+    return outline_from_doc(load_doc(file_id))
+
+def outline_from_doc(doc: Document, heading_styles: Optional[dict] = None) -> List[OutlineItem]:
     outline: List[OutlineItem] = []
     for i, p in enumerate(doc.paragraphs):
-        lvl = _heading_level(p)
+        lvl = style_level(p, heading_styles) if heading_styles is not None else _heading_level(p)
         pid = stable_paragraph_id(p.text, i, lvl)
         outline.append(OutlineItem(paragraph_id=pid, text=p.text or "", level=lvl))
     return outline
 
 def load_outline(file_id: str) -> List[OutlineItem]:
-    path = _outline_path(file_id)
+    path = storage.outline_path(file_id)
     if os.path.exists(path):
         try:
-            data = json.load(open(path, "r", encoding="utf-8"))
+            with open(path, "rb") as f:
+                data = wire.loads(f.read())
             return [OutlineItem(**x) for x in data]
         except Exception:
             pass
     return build_outline(file_id)
 
-def _find_insert_index_by_anchor(doc: Document, anchor_pid: str) -> Optional[int]:
-    # Recompute live paragraph IDs and match
-    current = []
-    for i, p in enumerate(doc.paragraphs):
-        lvl = _heading_level(p)
-        pid = stable_paragraph_id(p.text, i, lvl)
-        current.append((i, pid))
-    for idx, pid in current:
-        if pid == anchor_pid:
-            return idx + 1
+def _run_format(run) -> dict:
+    f = run.font
+    return {"font_name": f.name, "font_size": f.size, "bold": f.bold, "italic": f.italic}
+
+def _tally_runs(stats: dict, runs, sign: int = 1) -> None:
+    """Add (or with sign=-1 remove) runs from the font/size counters."""
+    for run in runs:
+        name, size = run.font.name, run.font.size
+        for key, val in (("font_counts", name), ("size_counts", str(size) if size else None)):
+            if not val:
+                continue
+            counts = stats[key]
+            counts[val] = counts.get(val, 0) + sign
+            if counts[val] <= 0:
+                del counts[val]
+
+def _refresh_defaults(stats: dict) -> None:
+    # ties go to the smallest key, so the result doesn't depend on counter order
+    fonts, sizes = stats["font_counts"], stats["size_counts"]
+    stats["default_font"] = max(sorted(fonts), key=fonts.get) if fonts else None
+    stats["default_size"] = int(max(sorted(sizes), key=sizes.get)) if sizes else None
+
+def _reference_format(doc: Document, heading_styles: dict) -> Optional[dict]:
+    """Format of the first body paragraph with runs; new paragraphs are given this format."""
+    for el in doc.element.body.iterchildren(qn("w:p")):
+        p = Paragraph(el, doc._body)
+        runs = p.runs
+        if runs and style_level(p, heading_styles) == 0:
+            return _run_format(runs[0])
     return None
 
-def _get_default_font(doc: Document) -> Optional[str]:
-    """Extract the most common font from existing paragraphs"""
-    font_counts = {}
+def compute_style_stats(doc: Document) -> dict:
+    """Formatting stats of a document: dominant font/size, reference body format, heading styles."""
+    heading_styles = {}
+    for s in doc.styles:
+        if s.type == WD_STYLE_TYPE.PARAGRAPH and (s.name or "").lower().startswith("heading"):
+            heading_styles[s.style_id] = style_heading_level(s.name)
+    stats = {"font_counts": {}, "size_counts": {}, "reference": None, "heading_styles": heading_styles}
     for p in doc.paragraphs:
-        for run in p.runs:
-            if run.font.name:
-                font_counts[run.font.name] = font_counts.get(run.font.name, 0) + 1
-    if font_counts:
-        return max(font_counts, key=font_counts.get)
-    return None
+        _tally_runs(stats, p.runs)
+    stats["reference"] = _reference_format(doc, heading_styles)
+    _refresh_defaults(stats)
+    return stats
+
+def load_style_stats(file_id: str, doc: Document, persist: bool = True) -> dict:
+    """Style stats for the current version; computed once, then maintained by apply_operations."""
+    path = storage.stats_path(file_id)
+    version = current_version(file_id)
+    if os.path.exists(path):
+        try:
+            stats = json.load(open(path, "r", encoding="utf-8"))
+            if stats.get("version") == version:
+                return stats
+        except Exception:
+            pass
+    stats = compute_style_stats(doc)
+    stats["version"] = version
+    if persist:
+        write_style_stats(file_id, stats)
+    return stats
+
+def load_block_index(file_id: str, doc: Document) -> List[list]:
+    """Preview block index for the current version (see preview.build_block_index)."""
+    if file_id.startswith(storage.REDLINE_PREFIX):
+        # redline outputs have no document directory to cache into and expire after REDLINE_TTL
+        return build_block_index(doc)
+    path = storage.blocks_path(file_id)
+    version = current_version(file_id)
+    if os.path.exists(path):
+        try:
+            data = json.load(open(path, "r", encoding="utf-8"))
+            if data.get("version") == version:
+                return data["blocks"]
+        except Exception:
+            pass
+    blocks = build_block_index(doc)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"version": version, "blocks": blocks}, f, ensure_ascii=False)
+    return blocks
 
-def _copy_paragraph_formatting(source_para, target_para):
-    """Copy formatting from source paragraph to target paragraph"""
-    if not source_para.runs:
-        return
+def write_style_stats(file_id: str, stats: dict) -> None:
+    with open(storage.stats_path(file_id), "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False)
 
-    # Get font from first run of source
-    source_run = source_para.runs[0]
+def _apply_reference_format(fmt: dict, target_para):
+    """Rewrite target paragraph as one run carrying the reference run format"""
     target_text = target_para.text
 
     # Clear target and recreate with formatting
@@ -117,284 +170,486 @@ def _copy_paragraph_formatting(source_para, target_para):
     new_run = target_para.add_run(target_text)
 
     # Copy font properties
-    if source_run.font.name:
-        new_run.font.name = source_run.font.name
-    if source_run.font.size:
-        new_run.font.size = source_run.font.size
-    new_run.font.bold = source_run.font.bold
-    new_run.font.italic = source_run.font.italic
-
-def apply_operations(file_id: str, operations: List[Operation]) -> Tuple[str, List[OutlineItem]]:
-    doc = load_doc(file_id)
-
-    # Get default font from document
-    default_font = _get_default_font(doc)
-    # Find a reference paragraph for formatting
-    ref_paragraph = None
-    for p in doc.paragraphs:
-        if p.runs and _heading_level(p) == 0:  # Get a normal paragraph
-            ref_paragraph = p
-            break
-
-    for op in operations:
-        if op.type == "add_heading":
+    if fmt["font_name"]:
+        new_run.font.name = fmt["font_name"]
+    if fmt["font_size"]:
+        new_run.font.size = Emu(fmt["font_size"])
+    new_run.font.bold = fmt["bold"]
+    new_run.font.italic = fmt["italic"]
+
+_TABLE_BORDERS_XML = ('<w:tblBorders>'
+    '<w:top w:val="single" w:sz="4"/>'
+    '<w:left w:val="single" w:sz="4"/>'
+    '<w:bottom w:val="single" w:sz="4"/>'
+    '<w:right w:val="single" w:sz="4"/>'
+    '<w:insideH w:val="single" w:sz="4"/>'
+    '<w:insideV w:val="single" w:sz="4"/>'
+    '</w:tblBorders>')
+
+def _run_content_xml(text: str) -> str:
+    # Same mapping python-docx applies on run.text: \n -> w:br, \t -> w:tab
+    parts = []
+    for i, line in enumerate(text.split("\n")):
+        if i:
+            parts.append('<w:br/>')
+        for j, chunk in enumerate(line.split("\t")):
+            if j:
+                parts.append('<w:tab/>')
+            if chunk:
+                parts.append(f'<w:t xml:space="preserve">{xml_escape(chunk)}</w:t>')
+    return "".join(parts)
+
+def _build_table_element(doc: Document, rows: int, cols: int, data: Optional[List[List[str]]],
+                         font_name: Optional[str], font_size: Optional[int], header_row: bool):
+    """Build a complete, formatted w:tbl in one parse instead of cell-by-cell.
+
+    Produces the same markup as add_table + cell.text + run.font edits: style
+    "Table Grid" (or plain borders when the style is missing), even column
+    widths, the document's dominant font and size (`font_size` in EMU; 11pt
+    when only the font is known) on all cells and bold header runs.
+    """
+    try:
+        style = f'<w:tblStyle w:val="{xml_escape(doc.styles["Table Grid"].style_id)}"/>'
+        borders = ''
+    except KeyError:
+        style, borders = '', _TABLE_BORDERS_XML
+    col_w = Emu(int(doc._block_width / cols)).twips
+    tc_pr = f'<w:tcPr><w:tcW w:type="dxa" w:w="{col_w}"/></w:tcPr>'
+    fonts = ''
+    if font_name:
+        name = xml_escape(font_name, {'"': '&quot;'})
+        fonts = f'<w:rFonts w:ascii="{name}" w:hAnsi="{name}"/>'
+    if font_size:
+        size = f'<w:sz w:val="{round(Emu(font_size).pt * 2)}"/>'
+    else:
+        size = '<w:sz w:val="22"/>' if font_name else ''
+
+    out = [f'<w:tbl {nsdecls("w")}><w:tblPr>{style}<w:tblW w:type="auto" w:w="0"/>{borders}'
+           '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+           '</w:tblPr><w:tblGrid>', f'<w:gridCol w:w="{col_w}"/>' * cols, '</w:tblGrid>']
+    data = data or []
+    for i in range(rows):
+        row = data[i] if i < len(data) else []
+        bold = '<w:b/>' if header_row and i == 0 else ''
+        rpr = f'<w:rPr>{fonts}{bold}{size}</w:rPr>' if (fonts or bold or size) else ''
+        out.append('<w:tr>')
+        for j in range(cols):
+            text = str(row[j]) if j < len(row) else ''
+            run = f'<w:r>{rpr}{_run_content_xml(text)}</w:r>' if text else ''
+            out.append(f'<w:tc>{tc_pr}<w:p>{run}</w:p></w:tc>')
+        out.append('</w:tr>')
+    out.append('</w:tbl>')
+    return parse_xml("".join(out))
+
+def _table_cells(table: Table) -> List:
+    """Row-major w:tc grid of a table, computed once per edit step.
+
+    Table.cell() recomputes the whole grid on every call; for tables without
+    merged cells the grid is just the w:tc children of each row.
+    """
+    tbl = table._tbl
+    if not tbl.xpath('./w:tr/w:tc/w:tcPr/*[self::w:gridSpan or self::w:vMerge]'):
+        return [tc for tr in tbl.tr_lst for tc in tr.tc_lst]
+    return [c._tc for c in table._cells]
+
+def _set_cell_texts(pairs: List[Tuple[object, str]]) -> None:
+    """Equivalent of `cell.text = text` for many cells, with a single XML parse."""
+    if not pairs:
+        return
+    body = parse_xml(f'<w:body {nsdecls("w")}>' + "".join(
+        f'<w:p><w:r>{_run_content_xml(text)}</w:r></w:p>' for _, text in pairs) + '</w:body>')
+    for (tc, _), p in zip(pairs, list(body)):
+        for child in list(tc):
+            if child.tag != qn('w:tcPr'):
+                tc.remove(child)
+        tc.append(p)
+
+def _execute_operations(doc: Document, stats: dict, operations: List[Operation], progress: Optional[Callable] = None) -> dict:
+    """Run an optimized plan against `doc` in memory, keeping `stats` in step; returns the plan report.
+
+    `progress(fraction, message)`, if given, is called before each step.
+    """
+    default_font, default_size = stats["default_font"], stats["default_size"]
+    ref_format = stats["reference"]
+
+    steps, report = optimize_operations(doc, operations, stats["heading_styles"])
+    # last element inserted after each anchor, so consecutive inserts keep plan order
+    tails = {}
+
+    def place_after(anchor, element):
+        if anchor is None:
+            return
+        after = tails.get(anchor, anchor)
+        after.addnext(element)
+        tails[anchor] = element
+
+    for n, step in enumerate(steps):
+        if progress:
+            progress(n / max(1, len(steps)), f"step {n + 1}/{len(steps)}: {step.type}")
+        op = step.op
+        if step.type == "add_heading":
             level = 1 if op.level is None else max(1, min(6, int(op.level)))
-            text = op.text or ""
-            if op.after_paragraph_id:
-                idx = _find_insert_index_by_anchor(doc, op.after_paragraph_id)
-                if idx is None: 
-                    p = doc.add_paragraph()
-                    p.style = f"Heading {level}"
-                    p.text = text
-                else:
-                    # python-docx lacks "insert at index"; rebuild lightly
-                    texts = [(p.text, _heading_level(p)) for p in doc.paragraphs]
-                    texts.insert(idx, (text, level))
-                    new_doc = Document()
-                    for t, lvl in texts:
-                        if lvl>0:
-                            h = new_doc.add_heading(t, level=lvl)
-                        else:
-                            new_doc.add_paragraph(t)
-                    doc = new_doc
-            else:
-                doc.add_heading(text, level=level)
-
-        elif op.type == "add_paragraph":
-            text = op.text or ""
-            if op.after_paragraph_id:
-                idx = _find_insert_index_by_anchor(doc, op.after_paragraph_id)
-                if idx is None:
-                    new_para = doc.add_paragraph(text)
-                    if ref_paragraph:
-                        _copy_paragraph_formatting(ref_paragraph, new_para)
-                else:
-                    texts = [(p.text, _heading_level(p)) for p in doc.paragraphs]
-                    texts.insert(idx, (text, 0))
-                    new_doc = Document()
-                    for t, lvl in texts:
-                        if lvl>0:
-                            new_doc.add_heading(t, level=lvl)
-                        else:
-                            new_para = new_doc.add_paragraph(t)
-                            if ref_paragraph:
-                                _copy_paragraph_formatting(ref_paragraph, new_para)
-                    doc = new_doc
-            else:
-                new_para = doc.add_paragraph(text)
-                if ref_paragraph:
-                    _copy_paragraph_formatting(ref_paragraph, new_para)
-
-        elif op.type == "replace_text":
-            if not op.find:
-                continue
+            h = doc.add_heading(op.text or "", level=level)
+            place_after(step.anchor, h._element)
+
+        elif step.type == "add_paragraph":
+            new_para = doc.add_paragraph(op.text or "")
+            if ref_format:
+                _apply_reference_format(ref_format, new_para)
+            _tally_runs(stats, new_para.runs)
+            place_after(step.anchor, new_para._element)
+
+        elif step.type == "replace_text":
+            # one pass over the paragraphs for the whole replace chain
             for p in doc.paragraphs:
-                if p.text and op.find in p.text:
-                    # Preserve formatting by replacing text in runs
-                    new_text = p.text.replace(op.find, op.replace or "")
-
-                    # Store original formatting
-                    original_runs = []
-                    for run in p.runs:
-                        original_runs.append({
-                            'font_name': run.font.name,
-                            'font_size': run.font.size,
-                            'bold': run.font.bold,
-                            'italic': run.font.italic
-                        })
-
-                    # Replace text
-                    p.clear()
-                    if original_runs:
-                        run = p.add_run(new_text)
-                        # Apply first run's formatting
-                        fmt = original_runs[0]
-                        if fmt['font_name']:
-                            run.font.name = fmt['font_name']
-                        if fmt['font_size']:
-                            run.font.size = fmt['font_size']
-                        run.font.bold = fmt['bold']
-                        run.font.italic = fmt['italic']
-                    else:
-                        p.add_run(new_text)
-
-        elif op.type == "insert_table":
+                text = p.text
+                if not text:
+                    continue
+                new_text, hit = text, False
+                for find, repl in step.replacements:
+                    if find in new_text:
+                        new_text, hit = new_text.replace(find, repl), True
+                if not hit:
+                    continue
+
+                # Preserve formatting: keep the first run's font
+                runs = p.runs
+                fmt = None
+                if runs:
+                    f = runs[0].font
+                    fmt = {'font_name': f.name, 'font_size': f.size, 'bold': f.bold, 'italic': f.italic}
+
+                _tally_runs(stats, runs, -1)
+                p.clear()
+                run = p.add_run(new_text)
+                if fmt:
+                    if fmt['font_name']:
+                        run.font.name = fmt['font_name']
+                    if fmt['font_size']:
+                        run.font.size = fmt['font_size']
+                    run.font.bold = fmt['bold']
+                    run.font.italic = fmt['italic']
+                _tally_runs(stats, [run])
+
+        elif step.type == "insert_table":
             rows = op.rows or (len(op.data) if op.data else 2)
             cols = op.cols or (len(op.data[0]) if (op.data and len(op.data)>0) else 2)
 
-            # Insert table with styling
-            from docx.shared import Pt
-            from docx.oxml import parse_xml
-            from docx.oxml.ns import nsdecls
-
-            # Find insertion position if after_paragraph_id is specified
-            insert_after_element = None
-            if op.after_paragraph_id:
-                for i, p in enumerate(doc.paragraphs):
-                    lvl = _heading_level(p)
-                    pid = stable_paragraph_id(p.text, i, lvl)
-                    if pid == op.after_paragraph_id:
-                        insert_after_element = p._element
-                        break
-
-            table = doc.add_table(rows=rows, cols=cols)
-
-            # Try to apply table style if available
-            try:
-                table.style = 'Table Grid'
-            except KeyError:
-                # If Table Grid doesn't exist, add borders manually
-                tbl = table._element
-                tblPr = tbl.tblPr
-                if tblPr is None:
-                    tblPr = parse_xml(r'<w:tblPr ' + nsdecls('w') + '/>')
-                    tbl.insert(0, tblPr)
-                # Add borders
-                tblBorders = parse_xml(r'<w:tblBorders ' + nsdecls('w') + '>'
-                    r'<w:top w:val="single" w:sz="4"/>'
-                    r'<w:left w:val="single" w:sz="4"/>'
-                    r'<w:bottom w:val="single" w:sz="4"/>'
-                    r'<w:right w:val="single" w:sz="4"/>'
-                    r'<w:insideH w:val="single" w:sz="4"/>'
-                    r'<w:insideV w:val="single" w:sz="4"/>'
-                    r'</w:tblBorders>')
-                tblPr.append(tblBorders)
-
-            # Populate table data
-            if op.data:
-                for i in range(min(rows, len(op.data))):
-                    for j in range(min(cols, len(op.data[i]))):
-                        cell = table.cell(i, j)
-                        cell.text = str(op.data[i][j])
-
-                        # Apply font formatting to match document
-                        if default_font and cell.paragraphs:
-                            for paragraph in cell.paragraphs:
-                                for run in paragraph.runs:
-                                    run.font.name = default_font
-                                    run.font.size = Pt(11)
-
-            # Add header row styling if requested
-            if op.add_header_row and rows > 0:
-                for cell in table.rows[0].cells:
+            # Build the whole table in one shot, then place it
+            tbl = _build_table_element(doc, rows, cols, op.data, default_font, default_size, bool(op.add_header_row))
+            doc.element.body._insert_tbl(tbl)
+            place_after(step.anchor, tbl)
+
+        elif step.type == "edit_table":
+            # All edits for one table in a single visit
+            table = Table(step.table, doc._body)
+            cells = _table_cells(table)
+            n_rows, n_cols = len(step.table.tr_lst), len(table.columns)
+            plain = []
+            for (r, c), (text, keep_format) in step.cells.items():
+                if r >= n_rows or c >= n_cols:
+                    continue
+                if not keep_format:
+                    plain.append((cells[r * n_cols + c], text))
+                    continue
+                cell = _Cell(cells[r * n_cols + c], table)
+
+                # Preserve formatting
+                original_font = None
+                if cell.paragraphs and cell.paragraphs[0].runs:
+                    original_font = {
+                        'name': cell.paragraphs[0].runs[0].font.name,
+                        'size': cell.paragraphs[0].runs[0].font.size,
+                        'bold': cell.paragraphs[0].runs[0].font.bold,
+                        'italic': cell.paragraphs[0].runs[0].font.italic
+                    }
+
+                cell.text = text
+
+                # Reapply formatting
+                if original_font and cell.paragraphs:
                     for paragraph in cell.paragraphs:
                         for run in paragraph.runs:
-                            run.font.bold = True
-
-            # Move table to correct position if specified
-            if insert_after_element is not None:
-                tbl_element = table._element
-                parent = insert_after_element.getparent()
-                # Find the index of the paragraph to insert after
-                index = list(parent).index(insert_after_element)
-                # Move table to position after the paragraph
-                parent.remove(tbl_element)
-                parent.insert(index + 1, tbl_element)
-
-        elif op.type == "edit_table":
-            # Edit existing table
-            if op.table_index is not None and op.table_index < len(doc.tables):
-                table = doc.tables[op.table_index]
-
-                # Edit specific cell
-                if op.cell_row is not None and op.cell_col is not None and op.cell_text is not None:
-                    if op.cell_row < len(table.rows) and op.cell_col < len(table.columns):
-                        cell = table.cell(op.cell_row, op.cell_col)
-
-                        # Preserve formatting
-                        original_font = None
-                        if cell.paragraphs and cell.paragraphs[0].runs:
-                            original_font = {
-                                'name': cell.paragraphs[0].runs[0].font.name,
-                                'size': cell.paragraphs[0].runs[0].font.size,
-                                'bold': cell.paragraphs[0].runs[0].font.bold,
-                                'italic': cell.paragraphs[0].runs[0].font.italic
-                            }
-
-                        cell.text = op.cell_text
-
-                        # Reapply formatting
-                        if original_font and cell.paragraphs:
-                            for paragraph in cell.paragraphs:
-                                for run in paragraph.runs:
-                                    if original_font['name']:
-                                        run.font.name = original_font['name']
-                                    if original_font['size']:
-                                        run.font.size = original_font['size']
-                                    run.font.bold = original_font['bold']
-                                    run.font.italic = original_font['italic']
-
-                # Populate all cells if data provided
-                elif op.data:
-                    for i in range(min(len(table.rows), len(op.data))):
-                        for j in range(min(len(table.columns), len(op.data[i]))):
-                            cell = table.cell(i, j)
-                            cell.text = str(op.data[i][j])
-
-        elif op.type == "remove_table":
-            # Remove table by index
-            if op.table_index is not None and op.table_index < len(doc.tables):
-                table = doc.tables[op.table_index]
-                # Get the table element and remove it from the document
-                tbl_element = table._element
-                tbl_element.getparent().remove(tbl_element)
-
-        elif op.type == "remove_paragraph":
-            # Remove paragraph by paragraph_id or by text match
-            if op.after_paragraph_id:
-                # Remove by stable paragraph ID
-                paragraphs_to_remove = []
-                for i, p in enumerate(doc.paragraphs):
-                    lvl = _heading_level(p)
-                    pid = stable_paragraph_id(p.text, i, lvl)
-                    if pid == op.after_paragraph_id:
-                        paragraphs_to_remove.append(p)
-
-                for p in paragraphs_to_remove:
-                    p_element = p._element
-                    p_element.getparent().remove(p_element)
-
-            elif op.find:
-                # Remove by text match (all paragraphs containing the text)
-                paragraphs_to_remove = []
-                for p in doc.paragraphs:
-                    if p.text and op.find in p.text:
-                        paragraphs_to_remove.append(p)
-
-                for p in paragraphs_to_remove:
-                    p_element = p._element
-                    p_element.getparent().remove(p_element)
+                            if original_font['name']:
+                                run.font.name = original_font['name']
+                            if original_font['size']:
+                                run.font.size = original_font['size']
+                            run.font.bold = original_font['bold']
+                            run.font.italic = original_font['italic']
+            _set_cell_texts(plain)
+
+        elif step.type in ("remove_table", "remove_paragraph"):
+            # Targets were resolved up front; drop them in one pass
+            for el in step.targets:
+                parent = el.getparent()
+                if parent is not None:
+                    if step.type == "remove_paragraph" and parent is doc.element.body:
+                        _tally_runs(stats, Paragraph(el, doc._body).runs, -1)
+                    parent.remove(el)
+
+    # inserts, rewrites and removals can all change which paragraph is the
+    # reference; rescanning stops at the first body paragraph with runs
+    stats["reference"] = _reference_format(doc, stats["heading_styles"])
+    _refresh_defaults(stats)
+    return report
+
+def apply_operations(file_id: str, operations: List[Operation], progress: Optional[Callable] = None) -> Tuple[str, List[OutlineItem], dict]:
+    """Apply, save and version `operations`.
+
+    `progress(fraction, message)` is only called before anything is written, so
+    a progress callback that raises (job cancellation) leaves the document untouched.
+    """
+    with storage.document_lock(file_id):
+        return _apply_operations(file_id, operations, progress)
+
+def _apply_operations(file_id: str, operations: List[Operation], progress: Optional[Callable]) -> Tuple[str, List[OutlineItem], dict]:
+    if progress:
+        progress(0.0, "loading")
+    doc = load_doc(file_id)
+
+    # Dominant font and reference body format, cached per version
+    stats = load_style_stats(file_id, doc)
+    step_progress = (lambda f, msg: progress(0.1 + 0.7 * f, msg)) if progress else None
+    report = _execute_operations(doc, stats, operations, step_progress)
+    if progress:
+        progress(0.8, "saving")
 
     # Save as new version (incremental)
     new_id = file_id  # keep same id; version separately
-    path = _file_path(new_id)
+    path = storage.file_path(new_id)
     doc.save(path)
 
     # Update outline and persist
-    outline = build_outline(new_id)
-    with open(_outline_path(new_id), "w", encoding="utf-8") as f:
-        json.dump([o.__dict__ for o in outline], f, ensure_ascii=False, indent=2)
+    outline = outline_from_doc(doc, stats["heading_styles"])
+    write_outline(new_id, outline)
 
     # Add version snapshot
-    save_version(new_id, path)
+    vname = save_version(new_id, path, operations, doc)
+
+    stats["version"] = int(vname[1:-5])
+    write_style_stats(new_id, stats)
 
-    return new_id, outline
+    return new_id, outline, report
 
-def save_version(file_id: str, src_path: str) -> str:
-    versions_dir = os.path.join(VERSIONS_DIR, file_id)
-    os.makedirs(versions_dir, exist_ok=True)
-    n = len([f for f in os.listdir(versions_dir) if f.endswith(".docx")])
-    vname = f"v{n+1}.docx"
-    dst = os.path.join(versions_dir, vname)
+def dry_run_operations(file_id: str, operations: List[Operation], with_preview: bool = False) -> dict:
+    """Apply `operations` to an in-memory copy only: nothing is saved, outlined, indexed or versioned."""
+    doc = load_doc(file_id)
+    stats = load_style_stats(file_id, doc, persist=False)
+    base_outline = load_outline(file_id)
+    report = _execute_operations(doc, stats, operations)
+    outline = outline_from_doc(doc, stats["heading_styles"])
+    diff = diff_outlines(base_outline, outline)
+    result = {
+        "file_id": file_id,
+        "dry_run": True,
+        "base_version": current_version(file_id),
+        "outline": outline,  # OutlineItems; the caller picks the wire format
+        "diff": diff,
+        "plan": report,
+    }
+    if with_preview:
+        result["html"] = _changed_blocks_html(doc, diff)
+    return result
+
+def _changed_blocks_html(doc: Document, diff: dict) -> str:
+    # Render just the blocks holding inserted or rewritten paragraphs
+    changed = {d["index"] for d in diff["inserted"]}
+    changed |= {d["index"] for d in diff["updated"] if "text" in d}
+    if not changed:
+        return ""
+    index = build_block_index(doc)
+    p_blocks = [i for i, b in enumerate(index) if b[0] == "p"]
+    return "\n".join(convert_docx_window(doc, index, p_blocks[k], p_blocks[k] + 1)
+                     for k in sorted(changed) if k < len(p_blocks))
+
+# --------- Versions: operation log with periodic checkpoints ---------
+# Every version is a catalog row recording the ops that produced it and its
+# parent version. Only checkpoints (v1, uploads/creates and every
+# CHECKPOINT_EVERY-th version) keep a full vN.docx; other versions are
+# rebuilt by replaying logged ops from the nearest checkpoint.
+CHECKPOINT_EVERY = int(os.environ.get("CHECKPOINT_EVERY", "10"))
+
+def load_oplog(file_id: str) -> Dict[int, dict]:
+    """Version -> log entry"""
+    return {e["version"]: e for e in storage.list_versions(file_id)}
+
+class ReplayDriftError(Exception):
+    """A version replayed from its checkpoint does not match the document originally saved."""
+
+def body_digest(doc: Document) -> str:
+    """sha1 of the canonical XML of the document body (the .docx itself differs per save)."""
+    return hashlib.sha1(etree.tostring(doc.element.body, method="c14n")).hexdigest()
+
+def save_version(file_id: str, src_path: str, operations: Optional[List[Operation]] = None, doc: Optional[Document] = None) -> str:
+    """Record a new version of file_id (the file at src_path) and make it the head.
+
+    Without `operations` (create/upload) the version is always a checkpoint.
+    `doc`, the saved document, fingerprints the version for rebuild_version.
+    """
+    storage.ensure_doc_dir(file_id)
+    head = storage.get_head(file_id)
+    ops = [op.model_dump(exclude_none=True) for op in operations] if operations is not None else None
+    n, checkpoint = storage.add_version(file_id, head[0] if head and head[0] else None, ops, CHECKPOINT_EVERY, src_path,
+                                        body_digest(doc) if doc is not None else None)
     import shutil
-    shutil.copy2(src_path, dst)
-    return vname
+    if checkpoint:
+        shutil.copy2(src_path, storage.checkpoint_path(file_id, n))
+    # keep the outline of this version next to the snapshot so deltas can be computed later
+    if os.path.exists(storage.outline_path(file_id)):
+        shutil.copy2(storage.outline_path(file_id), storage.version_outline_path(file_id, n))
+    return f"v{n}.docx"
 
 def list_versions(file_id: str):
-    versions_dir = os.path.join(VERSIONS_DIR, file_id)
-    if not os.path.exists(versions_dir): return []
-    items = sorted([f for f in os.listdir(versions_dir) if f.endswith(".docx")])
-    return items
+    return [f"v{e['version']}.docx" for e in storage.list_versions(file_id)]
+
+def current_version(file_id: str) -> int:
+    """Version the current file reflects (moves with undo/redo)."""
+    head = storage.get_head(file_id)
+    return head[0] if head else 0
+
+def rebuild_version(file_id: str, version: int) -> Document:
+    """Document at `version`, replayed in memory from the nearest checkpoint on its ancestry.
+
+    Raises ReplayDriftError if the replay doesn't reproduce the recorded body.
+    """
+    chain = []
+    v = version
+    while True:
+        entry = storage.get_version(file_id, v)
+        if entry is None:
+            raise FileNotFoundError(f"version {version} not found")
+        if entry["checkpoint"] and os.path.exists(storage.checkpoint_path(file_id, v)):
+            break
+        if entry["base"] is None:
+            raise FileNotFoundError(f"no checkpoint for version {version}")
+        chain.append(entry)
+        v = entry["base"]
+    doc = Document(storage.checkpoint_path(file_id, v))
+    if chain:
+        stats = compute_style_stats(doc)
+        for entry in reversed(chain):
+            _execute_operations(doc, stats, [Operation(**op) for op in entry["ops"] or []])
+        expected = chain[0]["body_sha1"]
+        if expected is not None and body_digest(doc) != expected:
+            raise ReplayDriftError(f"replaying version {version} from checkpoint v{v} does not reproduce the saved document")
+    return doc
+
+def _checkout(file_id: str, version: int, redo: List[int]) -> int:
+    # Make `version` the current file without recording a new version
+    doc = rebuild_version(file_id, version)
+    doc.save(storage.file_path(file_id))
+    storage.set_head(file_id, version, redo)
+    try:
+        outline = load_version_outline(file_id, version)
+    except FileNotFoundError:
+        outline = outline_from_doc(doc)
+    write_outline(file_id, outline)
+    return version
+
+def undo(file_id: str) -> int:
+    with storage.document_lock(file_id):
+        head, redo_stack = storage.get_head(file_id) or (0, [])
+        entry = storage.get_version(file_id, head)
+        if entry is None or entry["base"] is None:
+            raise ValueError("nothing to undo")
+        return _checkout(file_id, entry["base"], redo_stack + [head])
+
+def redo(file_id: str) -> int:
+    with storage.document_lock(file_id):
+        head, redo_stack = storage.get_head(file_id) or (0, [])
+        if not redo_stack:
+            raise ValueError("nothing to redo")
+        return _checkout(file_id, redo_stack[-1], redo_stack[:-1])
+
+def load_version_outline(file_id: str, version: int) -> List[OutlineItem]:
+    path = storage.version_outline_path(file_id, version)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            data = wire.loads(f.read())
+        return [OutlineItem(**x) for x in data]
+    # older stores have no per-version outline: rebuild it from the snapshot / log
+    return outline_from_doc(rebuild_version(file_id, version))
+
+def diff_outlines(old: List[OutlineItem], new: List[OutlineItem]) -> dict:
+    """Paragraph-level delta between two outlines.
+
+    `removed` indices refer to `old`, `inserted`/`updated` indices to `new`.
+    A client applies removals (descending), then insertions (ascending), then
+    merges each `updated` entry into the item at its index. Paragraph IDs are
+    salted with the paragraph index, so unchanged paragraphs that moved get a
+    new `paragraph_id`; rather than listing them, `reindex_from`/`reindex_to`
+    give the range of new indices whose IDs the client recomputes with
+    utils.stable_paragraph_id (both null if nothing moved).
+    """
+    removed, inserted, updated = [], [], []
+    reindex_from = reindex_to = None
+    sm = difflib.SequenceMatcher(a=[(o.text, o.level) for o in old], b=[(o.text, o.level) for o in new])
+    for opcode, i1, i2, j1, j2 in sm.get_opcodes():
+        if opcode == "equal":
+            if i1 != j1:
+                reindex_from = j1 if reindex_from is None else reindex_from
+                reindex_to = j2
+            continue
+        paired = min(i2 - i1, j2 - j1) if opcode == "replace" else 0
+        for k in range(paired):
+            updated.append({"index": j1+k, **new[j1+k].__dict__})
+        for k in range(i1 + paired, i2):
+            removed.append({"index": k, "paragraph_id": old[k].paragraph_id})
+        for k in range(j1 + paired, j2):
+            inserted.append({"index": k, **new[k].__dict__})
+    return {"removed": removed, "inserted": inserted, "updated": updated, "length": len(new),
+            "reindex_from": reindex_from, "reindex_to": reindex_to}
+
+def outline_delta(file_id: str, since: int, until: Optional[int] = None) -> dict:
+    until = current_version(file_id) if until is None else until
+    if since == until:
+        delta = {"removed": [], "inserted": [], "updated": [], "length": len(load_version_outline(file_id, until)),
+                 "reindex_from": None, "reindex_to": None}
+    else:
+        delta = diff_outlines(load_version_outline(file_id, since), load_version_outline(file_id, until))
+    return {"from_version": since, "to_version": until, **delta}
+
+# --------- Word add-in anchors ---------
+def reconcile_anchors(file_id: str, paragraphs: List[Tuple[int, str, int]], anchors: List[str]) -> dict:
+    """Map the add-in's paragraphs onto the stored outline and return the anchor changes.
+
+    `paragraphs` are (index, text_hash, level) as seen in Word, `anchors` the
+    anchor tags already present there. Paragraphs are aligned by (text hash,
+    level) like diff_outlines, so insertions on either side don't shift the
+    mapping; within a changed run of equal position, the Word paragraph takes
+    the ID of the stored one it replaced and is listed in `modified`.
+    `ids` follows the order of `paragraphs`; null means no stored counterpart.
+    """
+    outline = load_outline(file_id)
+    order = sorted(range(len(paragraphs)), key=lambda k: paragraphs[k][0])
+    ids: List[Optional[str]] = [None] * len(paragraphs)
+    modified, unmatched = [], []
+    sm = difflib.SequenceMatcher(
+        a=[(paragraphs[k][1], paragraphs[k][2]) for k in order],
+        b=[(text_hash(o.text), o.level) for o in outline],
+        autojunk=False)
+    for opcode, i1, i2, j1, j2 in sm.get_opcodes():
+        if opcode == "equal":
+            for k in range(i2 - i1):
+                ids[order[i1+k]] = outline[j1+k].paragraph_id
+            continue
+        paired = min(i2 - i1, j2 - j1) if opcode == "replace" else 0
+        for k in range(paired):
+            ids[order[i1+k]] = outline[j1+k].paragraph_id
+            modified.append(paragraphs[order[i1+k]][0])
+        unmatched.extend(paragraphs[order[k]][0] for k in range(i1 + paired, i2))
+
+    present = set(anchors)
+    wanted = {pid for pid in ids if pid}
+    return {
+        "file_id": file_id,
+        "version": current_version(file_id),
+        "ids": ids,
+        "add": [[paragraphs[k][0], ids[k]] for k in order if ids[k] and ids[k] not in present],
+        "drop": sorted(present - wanted),
+        "modified": modified,
+        "unmatched": unmatched,
+    }
 
 # --------- Redline-style compare (visual diff) ---------
 def _paragraph_texts(doc: Document):
@@ -410,7 +665,7 @@ def _apply_run_style(run, color: Optional[Tuple[int,int,int]]=None, underline=Fa
 
 def _compose_diff_doc(base_texts: List[str], revised_texts: List[str]) -> Document:
     # Very simple: line-based compare with word-diff inside changed lines
-    out = Document()
+    out = new_document()
     out.add_heading("Redline (visual) compare", level=1)
     sm = difflib.SequenceMatcher(a=base_texts, b=revised_texts)
     for opcode, i1, i2, j1, j2 in sm.get_opcodes():
@@ -450,12 +705,21 @@ def _compose_diff_doc(base_texts: List[str], revised_texts: List[str]) -> Docume
                         _apply_run_style(r2, color=(0,140,0), underline=True)
     return out
 
-def redline_compare(base_id: str, revised_id: str) -> str:
+def redline_compare(base_id: str, revised_id: str, progress: Optional[Callable] = None) -> str:
+    if progress:
+        progress(0.0, "loading documents")
     base = load_doc(base_id)
     rev = load_doc(revised_id)
     base_texts = _paragraph_texts(base)
     revised_texts = _paragraph_texts(rev)
+    if progress:
+        progress(0.3, "comparing")
     out = _compose_diff_doc(base_texts, revised_texts)
-    out_id = f"compare-{uuid.uuid4()}"
-    out.save(os.path.join(STORAGE_DIR, f"{out_id}.docx"))
+    if progress:
+        progress(0.8, "saving")
+    out_id = f"{storage.REDLINE_PREFIX}{uuid.uuid4()}"
+    os.makedirs(os.path.dirname(storage.redline_path(out_id)), exist_ok=True)
+    out.save(storage.redline_path(out_id))
+    storage.register_redline(out_id, base_id, revised_id)
+    storage.gc_redlines()
     return out_id
@@ -0,0 +1,269 @@
+"""
+Background jobs: a persistent queue (SQLite, STORAGE_DIR/jobs.db) drained by a
+pool of worker threads, for work that would otherwise hold an HTTP request open
+(large redlines, bulk apply-ops, previews of long documents).
+
+Handlers are registered per kind and called as handler(params, progress).
+`progress(fraction, message)` records progress and is also the cancellation
+point: once a job is cancelled, the next progress call raises JobCancelled.
+Progress is written at most every PROGRESS_INTERVAL seconds unless it moved by
+PROGRESS_STEP; cancellations made in this process are seen immediately, ones
+from other processes on the next write.
+
+Queued jobs survive a restart. Jobs that were running when the process stopped
+are queued again if their kind is safe to re-run, otherwise marked failed.
+"""
+import os, json, time, uuid, sqlite3, threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import storage
+
+JOBS_PATH = os.path.join(storage.STORAGE_DIR, "jobs.db")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_TTL = int(os.environ.get("JOB_TTL", str(24 * 3600)))
+PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", "0.5"))
+PROGRESS_STEP = 0.05
+
+FINISHED = ("done", "failed", "cancelled")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created);
+"""
+
+
+class JobCancelled(Exception):
+    """Raised from a progress callback once the job has been cancelled."""
+
+
+_init_lock = threading.Lock()
+_initialized = False
+_handlers: Dict[str, Tuple[Callable, bool]] = {}
+_wake = threading.Event()
+_stop = threading.Event()
+_workers: List[threading.Thread] = []
+# running jobs flagged by cancel() in this process
+_cancelled: Set[str] = set()
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+    conn = sqlite3.connect(JOBS_PATH, timeout=30)
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                _initialized = True
+    return conn
+
+
+def register(kind: str, handler: Callable, rerun_on_restart: bool = True) -> None:
+    """`rerun_on_restart=False` for handlers with side effects that must not run twice."""
+    _handlers[kind] = (handler, rerun_on_restart)
+
+
+# --------- Queue API ---------
+def submit(kind: str, params: dict) -> str:
+    if kind not in _handlers:
+        raise ValueError(f"unknown job kind '{kind}'")
+    job_id = str(uuid.uuid4())
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT INTO jobs(id, kind, params, status, created) VALUES (?,?,?,?,?)",
+                         (job_id, kind, json.dumps(params, ensure_ascii=False), "queued", time.time()))
+    finally:
+        conn.close()
+    _wake.set()
+    return job_id
+
+
+def get(job_id: str) -> Optional[dict]:
+    """Status of a job, without its result."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT id, kind, status, progress, message, error, created, started, finished FROM jobs WHERE id = ?",
+            (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    keys = ("job_id", "kind", "status", "progress", "message", "error", "created", "started", "finished")
+    return dict(zip(keys, row))
+
+
+def result(job_id: str) -> Optional[Tuple[str, Optional[dict]]]:
+    """(status, result); result is None until the job is done."""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT status, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]) if row[1] is not None else None
+
+
+def cancel(job_id: str) -> Optional[str]:
+    """Cancel a queued job outright, or flag a running one; returns the resulting status."""
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'",
+                         (time.time(), job_id))
+            cur = conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if cur.rowcount:
+            _cancelled.add(job_id)
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def purge_finished(ttl: int = JOB_TTL) -> int:
+    conn = _connect()
+    try:
+        with conn:
+            cur = conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({','.join('?' * len(FINISHED))}) AND finished < ?",
+                (*FINISHED, time.time() - ttl))
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+# --------- Workers ---------
+def _claim() -> Optional[Tuple[str, str, dict]]:
+    conn = _connect()
+    try:
+        while True:
+            row = conn.execute("SELECT id, kind, params FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is None:
+                return None
+            with conn:
+                cur = conn.execute("UPDATE jobs SET status = 'running', started = ?, progress = 0 WHERE id = ? AND status = 'queued'",
+                                   (time.time(), row[0]))
+            if cur.rowcount == 1:
+                return row[0], row[1], json.loads(row[2])
+            # taken by another worker (or cancelled) in between; try the next one
+    finally:
+        conn.close()
+
+
+def _progress_callback(job_id: str) -> Callable[[float, str], None]:
+    last = {"time": None, "fraction": 0.0}
+
+    def progress(fraction: float, message: str = "") -> None:
+        if job_id in _cancelled:
+            raise JobCancelled()
+        fraction = max(0.0, min(1.0, fraction))
+        now = time.monotonic()
+        if (last["time"] is not None and now - last["time"] < PROGRESS_INTERVAL
+                and abs(fraction - last["fraction"]) < PROGRESS_STEP):
+            return
+        last["time"], last["fraction"] = now, fraction
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute("UPDATE jobs SET progress = ?, message = ? WHERE id = ?", (fraction, message, job_id))
+                (cancelled,) = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if cancelled:
+            raise JobCancelled()
+    return progress
+
+
+def _finish(job_id: str, status: str, result_data=None, error: Optional[str] = None) -> None:
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END WHERE id = ?",
+                (status, json.dumps(result_data, ensure_ascii=False) if result_data is not None else None,
+                 error, time.time(), status, job_id))
+    finally:
+        conn.close()
+
+
+def _run(job_id: str, kind: str, params: dict) -> None:
+    entry = _handlers.get(kind)
+    if entry is None:
+        _finish(job_id, "failed", error=f"unknown job kind '{kind}'")
+        return
+    try:
+        out = entry[0](params, _progress_callback(job_id))
+    except JobCancelled:
+        _finish(job_id, "cancelled")
+    except Exception as e:
+        _finish(job_id, "failed", error=str(e) or type(e).__name__)
+    else:
+        _finish(job_id, "done", out)
+    finally:
+        _cancelled.discard(job_id)
+
+
+def _worker() -> None:
+    while not _stop.is_set():
+        job = _claim()
+        if job is None:
+            # woken by submit(); the timeout also picks up jobs queued by other processes
+            _wake.wait(1.0)
+            _wake.clear()
+            continue
+        _run(*job)
+
+
+def _recover() -> None:
+    """Requeue (or fail) jobs left running by a previous process."""
+    now = time.time()
+    conn = _connect()
+    try:
+        with conn:
+            for job_id, kind, cancel_requested in conn.execute(
+                    "SELECT id, kind, cancel_requested FROM jobs WHERE status = 'running'").fetchall():
+                entry = _handlers.get(kind)
+                if cancel_requested:
+                    conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?", (now, job_id))
+                elif entry is not None and entry[1]:
+                    conn.execute("UPDATE jobs SET status = 'queued', started = NULL, progress = 0, message = NULL WHERE id = ?", (job_id,))
+                else:
+                    conn.execute("UPDATE jobs SET status = 'failed', error = 'interrupted by restart', finished = ? WHERE id = ?",
+                                 (now, job_id))
+    finally:
+        conn.close()
+
+
+def start(workers: int = JOB_WORKERS) -> None:
+    if _workers:
+        return
+    _stop.clear()
+    _recover()
+    purge_finished()
+    for i in range(max(1, workers)):
+        t = threading.Thread(target=_worker, name=f"job-worker-{i}", daemon=True)
+        t.start()
+        _workers.append(t)
+
+
+def stop(timeout: float = 5.0) -> None:
+    """Stop taking new jobs; running ones finish (or are recovered on next start)."""
+    _stop.set()
+    _wake.set()
+    for t in _workers:
+        t.join(timeout)
+    _workers.clear()
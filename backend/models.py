@@ -1,5 +1,5 @@
-from typing import List, Optional, Literal
-from pydantic import BaseModel
+from typing import Any, Dict, List, Optional, Literal, Tuple
+from pydantic import BaseModel, Field
 
 # Operation types, now supporting stable anchors by paragraph_id
 OpType = Literal["add_heading", "add_paragraph", "replace_text", "insert_table", "edit_table", "remove_table", "remove_paragraph"]
@@ -28,12 +28,39 @@ class PlanOpsRequest(BaseModel):
 class ApplyOpsRequest(BaseModel):
     file_id: str
     operations: List[Operation]
+    return_delta: bool = False  # respond with an outline delta instead of the full outline
+    dry_run: bool = False  # run in memory only; no save, outline, index or version
+    preview: bool = False  # with dry_run: include HTML for the changed paragraphs
+    outline_format: Literal["items", "columns"] = "items"  # "columns": parallel arrays, see wire.py
+    text_limit: Optional[int] = Field(None, ge=0)  # truncate outline texts to this many characters
 
 class CreateDocRequest(BaseModel):
     title: str = "New Document"
     body: Optional[str] = None
+    template_id: Optional[str] = None  # a template registered via POST /api/templates
 
 class OutlineItem(BaseModel):
     paragraph_id: str
     text: str
     level: int  # 0 for body para, 1..6 for headings
+
+class AnchorReconcileRequest(BaseModel):
+    file_id: str
+    paragraphs: List[Tuple[int, str, int]]  # (index, text_hash, level) per Word paragraph; see utils.text_hash
+    anchors: List[str] = []  # anchor tags currently present in the Word document
+
+JobKind = Literal["redline", "apply_ops", "preview"]
+
+class JobRequest(BaseModel):
+    kind: JobKind
+    params: Dict[str, Any] = {}  # RedlineJobParams, ApplyOpsRequest or PreviewJobParams fields
+
+class RedlineJobParams(BaseModel):
+    base_id: str
+    revised_id: str
+
+class PreviewJobParams(BaseModel):
+    file_id: str
+    offset: Optional[int] = None
+    limit: Optional[int] = None
+    section: Optional[str] = None
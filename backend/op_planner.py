@@ -0,0 +1,198 @@
+"""
+Operation-plan optimizer: resolves anchors once and coalesces redundant ops
+before apply_operations executes them.
+
+All targets (after_paragraph_id anchors, remove_paragraph ids / find matches,
+table_index) are resolved against the document as it was when the plan was
+made, i.e. the outline the planner saw. Paragraphs created by the plan itself
+cannot be targeted by later ops in the same plan.
+"""
+from typing import Dict, List, Optional, Tuple
+from docx import Document
+from models import Operation
+from utils import stable_paragraph_id, heading_level, style_level
+
+
+class PlanConflictError(ValueError):
+    """Raised when two ops in a plan cannot both be honoured."""
+
+
+class PlanStep:
+    """One unit of execution; may stand for several merged source ops."""
+
+    def __init__(self, type: str, sources: List[int], op: Optional[Operation] = None, anchor=None):
+        self.type = type
+        self.sources = sources      # indices into the original operation list
+        self.op = op                # representative op (inserts)
+        self.anchor = anchor        # resolved w:p element to insert after, or None to append
+        self.targets = []           # resolved w:p / w:tbl elements (removals)
+        self.replacements: List[Tuple[str, str]] = []  # (find, replace) chain, applied in order
+        self.table = None           # resolved w:tbl element (edit_table)
+        self.cells: Dict[Tuple[int, int], Tuple[str, bool]] = {}  # (row, col) -> (text, keep_format)
+
+    def summary(self) -> dict:
+        out = {"type": self.type, "sources": self.sources}
+        if self.targets:
+            out["targets"] = len(self.targets)
+        if self.replacements:
+            out["replacements"] = len(self.replacements)
+        if self.cells:
+            out["cells"] = len(self.cells)
+        return out
+
+
+def _resolve_anchor(index: Dict[str, object], pid: Optional[str], i: int, unresolved: List[dict]):
+    if not pid:
+        return None
+    el = index.get(pid)
+    if el is None:
+        unresolved.append({"op": i, "paragraph_id": pid})
+    return el
+
+
+def _may_interact(find: str, text: str) -> bool:
+    """True if an occurrence of `text` can overlap an occurrence of `find`.
+
+    A replace_text A->B (B non-empty) can only create or destroy a match of
+    `find` where an occurrence of A (or B) overlaps it, which needs containment
+    or a common suffix/prefix. Deleting A (B empty) can create a match anywhere.
+    """
+    if find in text or text in find:
+        return True
+    n = min(len(find), len(text))
+    return any(find.endswith(text[:k]) or text.endswith(find[:k]) for k in range(1, n))
+
+
+def optimize_operations(doc: Document, operations: List[Operation], heading_styles: Optional[dict] = None) -> Tuple[List[PlanStep], dict]:
+    """Turn a raw op list into execution steps plus a before/after report.
+
+    - anchors and removal targets are resolved in a single paragraph pass
+    - all remove_paragraph / remove_table ops become one removal pass at the end
+    - consecutive replace_text ops become one chain applied per paragraph
+    - edit_table ops are merged into one step per table (last write per cell wins)
+    - duplicate removals are dropped
+    - an op targeting a paragraph or table removed earlier in the plan raises PlanConflictError,
+      as does a remove_paragraph `find` whose matches an earlier replace or insert could change
+
+    `heading_styles` ({style_id: level}, from the cached style stats) avoids a
+    style lookup per paragraph when computing anchor IDs.
+    """
+    paragraphs = doc.paragraphs
+    index: Dict[str, object] = {}
+    for i, p in enumerate(paragraphs):
+        lvl = style_level(p, heading_styles) if heading_styles is not None else heading_level(p)
+        index.setdefault(stable_paragraph_id(p.text, i, lvl), p._element)
+    tables = [t._element for t in doc.tables]
+
+    steps: List[PlanStep] = []
+    para_removal = PlanStep("remove_paragraph", [])
+    table_removal = PlanStep("remove_table", [])
+    removed_paras: Dict[object, int] = {}
+    removed_tables: Dict[object, int] = {}
+    table_steps: Dict[object, PlanStep] = {}
+    unresolved: List[dict] = []
+    dropped: List[dict] = []
+    inserted: List[Tuple[int, str]] = []  # (op, text) of paragraphs added so far
+    replaced: List[Tuple[int, str]] = []  # (op, find or replace string) of replace_text ops so far
+    deleting: List[int] = []  # replace_text ops with an empty replacement; they can join text into any match
+
+    def check_alive(el, i: int, what: str):
+        if el in removed_paras:
+            raise PlanConflictError(f"operation {i} targets {what} removed by operation {removed_paras[el]}")
+
+    for i, op in enumerate(operations):
+        if op.type in ("add_heading", "add_paragraph", "insert_table"):
+            if op.type != "insert_table" and op.text:
+                inserted.append((i, op.text))
+            anchor = _resolve_anchor(index, op.after_paragraph_id, i, unresolved)
+            if anchor is not None:
+                check_alive(anchor, i, f"anchor {op.after_paragraph_id}")
+            steps.append(PlanStep(op.type, [i], op=op, anchor=anchor))
+
+        elif op.type == "replace_text":
+            if not op.find:
+                dropped.append({"op": i, "reason": "empty find"})
+                continue
+            prev = steps[-1] if steps and steps[-1].type == "replace_text" else None
+            pair = (op.find, op.replace or "")
+            if prev is None:
+                prev = PlanStep("replace_text", [])
+                steps.append(prev)
+            prev.sources.append(i)
+            prev.replacements.append(pair)
+            replaced.extend((i, t) for t in pair if t)
+            if not pair[1]:
+                deleting.append(i)
+
+        elif op.type == "remove_paragraph":
+            if op.after_paragraph_id:
+                found = _resolve_anchor(index, op.after_paragraph_id, i, unresolved)
+                targets = [found] if found is not None else []
+            elif op.find:
+                # matched against the pre-plan text, so earlier edits must not affect the match
+                changed_by = [j for j, text in inserted if op.find in text]
+                changed_by += [j for j, text in replaced if _may_interact(op.find, text)]
+                changed_by += deleting
+                if changed_by:
+                    raise PlanConflictError(
+                        f"operation {i} removes paragraphs containing {op.find!r}, which operation {min(changed_by)} may change; "
+                        "split the plan or remove by paragraph id")
+                targets = [p._element for p in paragraphs if p.text and op.find in p.text]
+            else:
+                targets = []
+            fresh = [el for el in targets if el not in removed_paras]
+            if not fresh:
+                dropped.append({"op": i, "reason": "nothing to remove"})
+                continue
+            for el in fresh:
+                removed_paras[el] = i
+            para_removal.sources.append(i)
+            para_removal.targets.extend(fresh)
+
+        elif op.type in ("edit_table", "remove_table"):
+            if op.table_index is None or op.table_index >= len(tables):
+                dropped.append({"op": i, "reason": "table not found"})
+                continue
+            tbl = tables[op.table_index]
+            if tbl in removed_tables:
+                if op.type == "remove_table":
+                    dropped.append({"op": i, "reason": "duplicate"})
+                    continue
+                raise PlanConflictError(f"operation {i} edits table {op.table_index} removed by operation {removed_tables[tbl]}")
+            if op.type == "remove_table":
+                removed_tables[tbl] = i
+                table_removal.sources.append(i)
+                table_removal.targets.append(tbl)
+                # edits to a table that is removed later are wasted work
+                step = table_steps.pop(tbl, None)
+                if step is not None:
+                    steps.remove(step)
+                    dropped.extend({"op": s, "reason": "table removed later"} for s in step.sources)
+                continue
+            step = table_steps.get(tbl)
+            if step is None:
+                step = table_steps[tbl] = PlanStep("edit_table", [])
+                step.table = tbl
+                steps.append(step)
+            step.sources.append(i)
+            if op.cell_row is not None and op.cell_col is not None and op.cell_text is not None:
+                step.cells[(op.cell_row, op.cell_col)] = (op.cell_text, True)
+            elif op.data:
+                for r, row in enumerate(op.data):
+                    for c, val in enumerate(row):
+                        step.cells[(r, c)] = (str(val), False)
+
+    if para_removal.targets:
+        steps.append(para_removal)
+    if table_removal.targets:
+        steps.append(table_removal)
+
+    report = {
+        "ops_before": len(operations),
+        "ops_after": len(steps),
+        "before": [op.type for op in operations],
+        "after": [s.summary() for s in steps],
+        "dropped": dropped,
+        "unresolved": unresolved,
+    }
+    return steps, report
@@ -1,198 +1,384 @@
 """
 Enhanced DOCX to HTML converter with numbering support
 """
+from collections import OrderedDict
 from docx import Document
 from docx.oxml.ns import qn
-from typing import Dict, List
+from docx.styles import BabelFish
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from typing import Dict, List, Optional, Tuple
+import hashlib
 import html
+import threading
+from utils import stable_paragraph_id, style_heading_level
 
 
-class DocxToHtmlConverter:
-    def __init__(self, doc: Document):
-        self.doc = doc
-        self.numbering_dict = self._parse_numbering()
-        self.list_counters = {}  # Track current counter for each list level
-
-    def _parse_numbering(self) -> Dict:
-        """Parse numbering definitions from the document"""
-        numbering_dict = {}
-        try:
-            numbering_part = self.doc.part.numbering_part
-            if numbering_part is None:
-                return {}
+def _val(el, tag: str) -> Optional[str]:
+    child = el.find(qn(tag)) if el is not None else None
+    return child.get(qn('w:val')) if child is not None else None
 
-            # Parse abstract numbering definitions
-            for abstractNum in numbering_part.element.findall('.//' + qn('w:abstractNum')):
-                abstractNumId = abstractNum.get(qn('w:abstractNumId'))
-                levels = {}
 
-                for lvl in abstractNum.findall('.//' + qn('w:lvl')):
-                    ilvl = lvl.get(qn('w:ilvl'))
-                    numFmt = lvl.find('.//' + qn('w:numFmt'))
-                    lvlText = lvl.find('.//' + qn('w:lvlText'))
+def _int(v: Optional[str]) -> Optional[int]:
+    try:
+        return int(v) if v is not None else None
+    except ValueError:
+        return None
 
-                    fmt = numFmt.get(qn('w:val')) if numFmt is not None else 'decimal'
-                    text = lvlText.get(qn('w:val')) if lvlText is not None else '%1.'
 
-                    levels[ilvl] = {'format': fmt, 'text': text}
+class NumberingModel:
+    """Parsed w:numbering part: abstract list definitions and num instances.
+
+    Each num keeps its own level table (abstract levels with any
+    lvlOverride/w:lvl merged in) and its startOverride values.
+    """
+
+    def __init__(self, numbering_el):
+        self.abstract: Dict[str, Dict[int, dict]] = {}
+        self.nums: Dict[str, dict] = {}
+        for abstractNum in numbering_el.iterchildren(qn('w:abstractNum')):
+            levels = {}
+            for lvl in abstractNum.iterchildren(qn('w:lvl')):
+                levels[_int(lvl.get(qn('w:ilvl'))) or 0] = self._parse_level(lvl)
+            self.abstract[abstractNum.get(qn('w:abstractNumId'))] = levels
+
+        for num in numbering_el.iterchildren(qn('w:num')):
+            abstract_id = _val(num, 'w:abstractNumId')
+            if abstract_id not in self.abstract:
+                continue
+            levels = dict(self.abstract[abstract_id])
+            starts = {}
+            for override in num.iterchildren(qn('w:lvlOverride')):
+                ilvl = _int(override.get(qn('w:ilvl'))) or 0
+                lvl = override.find(qn('w:lvl'))
+                if lvl is not None:
+                    levels[ilvl] = self._parse_level(lvl, levels.get(ilvl))
+                start = _int(_val(override, 'w:startOverride'))
+                if start is not None:
+                    starts[ilvl] = start
+            self.nums[num.get(qn('w:numId'))] = {'abstract': abstract_id, 'levels': levels, 'starts': starts}
+
+    @staticmethod
+    def _parse_level(lvl, base: Optional[dict] = None) -> dict:
+        base = base or {'format': 'decimal', 'text': '%1.', 'start': 1, 'restart': None}
+        fmt = _val(lvl, 'w:numFmt')
+        text = _val(lvl, 'w:lvlText')
+        start = _int(_val(lvl, 'w:start'))
+        restart = _int(_val(lvl, 'w:lvlRestart'))
+        return {
+            'format': fmt if fmt is not None else base['format'],
+            'text': text if text is not None else base['text'],
+            'start': start if start is not None else base['start'],
+            'restart': restart if restart is not None else base['restart'],
+        }
+
+    def level(self, numId: str, ilvl: int) -> Optional[dict]:
+        num = self.nums.get(numId)
+        return num['levels'].get(ilvl) if num else None
+
+
+class StyleModel:
+    """Parsed w:styles part: UI names, basedOn chain and style-level numbering."""
+
+    def __init__(self, styles_el):
+        self.styles: Dict[str, dict] = {}
+        self.default_paragraph: Optional[str] = None
+        for style in styles_el.iterchildren(qn('w:style')):
+            style_id = style.get(qn('w:styleId'))
+            name = _val(style, 'w:name')
+            numPr = style.find(qn('w:pPr') + '/' + qn('w:numPr'))
+            self.styles[style_id] = {
+                'name': BabelFish.internal2ui(name) if name else style_id,
+                'basedOn': _val(style, 'w:basedOn'),
+                'numId': _val(numPr, 'w:numId'),
+                'ilvl': _int(_val(numPr, 'w:ilvl')),
+            }
+            if style.get(qn('w:type')) == 'paragraph' and style.get(qn('w:default')) in ('1', 'true', 'on'):
+                self.default_paragraph = style_id
+
+    def resolve(self, style_id: Optional[str]) -> Optional[str]:
+        # Unknown or missing style ids fall back to the default paragraph style, as in python-docx
+        return style_id if style_id in self.styles else self.default_paragraph
+
+    def name(self, style_id: Optional[str]) -> str:
+        style = self.styles.get(self.resolve(style_id))
+        return style['name'] if style else 'Normal'
+
+    def numbering(self, style_id: Optional[str]) -> Optional[Tuple[str, int]]:
+        """(numId, ilvl) inherited through the basedOn chain, if any."""
+        seen = set()
+        sid = self.resolve(style_id)
+        while sid in self.styles and sid not in seen:
+            seen.add(sid)
+            style = self.styles[sid]
+            if style['numId'] is not None:
+                return style['numId'], style['ilvl'] or 0
+            sid = style['basedOn']
+        return None
 
-                numbering_dict[abstractNumId] = levels
 
-            # Map num IDs to abstract num IDs
-            for num in numbering_part.element.findall('.//' + qn('w:num')):
-                numId = num.get(qn('w:numId'))
-                abstractNumId_elem = num.find('.//' + qn('w:abstractNumId'))
-                if abstractNumId_elem is not None:
-                    abstractNumId = abstractNumId_elem.get(qn('w:val'))
-                    if abstractNumId in numbering_dict:
-                        numbering_dict[numId] = numbering_dict[abstractNumId]
+# Parsed models keyed by content hash, shared across requests and documents
+_MODEL_CACHE_SIZE = 64
+_model_cache: "OrderedDict[Tuple[str, str], object]" = OrderedDict()
+_model_lock = threading.Lock()
+
+
+def _cached_model(kind: str, part, factory):
+    digest = hashlib.sha1(part.blob).hexdigest()
+    key = (kind, digest)
+    with _model_lock:
+        model = _model_cache.get(key)
+        if model is not None:
+            _model_cache.move_to_end(key)
+            return model
+    model = factory(part.element)
+    with _model_lock:
+        _model_cache[key] = model
+        if len(_model_cache) > _MODEL_CACHE_SIZE:
+            _model_cache.popitem(last=False)
+    return model
+
+
+class ListCounters:
+    """Word-style list counters for one rendering pass.
+
+    Counters are shared by all nums of the same abstract definition; a num's
+    startOverride restarts its levels on first use, and incrementing a level
+    resets deeper levels according to their lvlRestart.
+    """
+
+    def __init__(self, model: NumberingModel):
+        self.model = model
+        self.counts: Dict[str, Dict[int, int]] = {}
+        self.pending_starts: Dict[Tuple[str, int], int] = {}
+        self.seen_nums = set()
+
+    def next(self, numId: str, ilvl: int) -> int:
+        num = self.model.nums[numId]
+        aid = num['abstract']
+        counts = self.counts.setdefault(aid, {})
+        if numId not in self.seen_nums:
+            self.seen_nums.add(numId)
+            for lvl, start in num['starts'].items():
+                counts.pop(lvl, None)
+                self.pending_starts[(aid, lvl)] = start
+
+        if ilvl in counts:
+            counts[ilvl] += 1
+        else:
+            counts[ilvl] = self.pending_starts.pop((aid, ilvl), num['levels'][ilvl]['start'])
+
+        for deeper in [d for d in counts if d > ilvl]:
+            restart = (num['levels'].get(deeper) or {}).get('restart')
+            if restart is None or (restart > 0 and ilvl <= restart - 1):
+                del counts[deeper]
+        return counts[ilvl]
+
+    def marker(self, numId: str, ilvl: int) -> str:
+        """Render lvlText (e.g. "%1.%2.") with the current counters."""
+        num = self.model.nums[numId]
+        level = num['levels'][ilvl]
+        if level['format'] == 'bullet':
+            return '•'
+        counts = self.counts.get(num['abstract'], {})
+        text = level['text']
+        for k in range(9, 0, -1):
+            token = f'%{k}'
+            if token in text:
+                lv = num['levels'].get(k - 1) or level
+                value = counts.get(k - 1, lv['start'])
+                text = text.replace(token, _format_number(value, lv['format']))
+        return text
+
+
+def _to_roman(num: int) -> str:
+    """Convert number to Roman numerals"""
+    val = [1000, 900, 500, 400, 100, 90, 50, 40, 10, 9, 5, 4, 1]
+    syms = ['M', 'CM', 'D', 'CD', 'C', 'XC', 'L', 'XL', 'X', 'IX', 'V', 'IV', 'I']
+    result = ''
+    for i in range(len(val)):
+        count = int(num / val[i])
+        if count:
+            result += syms[i] * count
+            num -= val[i] * count
+    return result
+
+
+def _format_number(counter: int, fmt: str) -> str:
+    """Format a counter based on numbering format"""
+    if fmt == 'decimal':
+        return str(counter)
+    elif fmt == 'decimalZero':
+        return f'{counter:02d}'
+    elif fmt == 'upperRoman':
+        return _to_roman(counter).upper()
+    elif fmt == 'lowerRoman':
+        return _to_roman(counter).lower()
+    elif fmt in ('upperLetter', 'lowerLetter'):
+        # A..Z, then AA..ZZ, as Word does
+        letter = chr(65 + (counter - 1) % 26) * ((counter - 1) // 26 + 1) if counter > 0 else ''
+        return letter if fmt == 'upperLetter' else letter.lower()
+    elif fmt == 'bullet':
+        return '•'
+    elif fmt == 'none':
+        return ''
+    else:
+        return str(counter)
 
-        except Exception as e:
-            print(f"Error parsing numbering: {e}")
 
-        return numbering_dict
+class DocxToHtmlConverter:
+    def __init__(self, doc: Document):
+        self.doc = doc
+        self.numbering = self._parse_numbering()
+        self.styles = self._parse_styles()
+        self.list_counters = ListCounters(self.numbering)
 
-    def _get_numbering_info(self, paragraph):
-        """Extract numbering information from a paragraph"""
+    def _parse_numbering(self) -> NumberingModel:
+        """Numbering definitions of the document (shared cache, keyed by part hash)"""
         try:
-            pPr = paragraph._element.find(qn('w:pPr'))
-            if pPr is None:
-                return None
-
-            numPr = pPr.find(qn('w:numPr'))
-            if numPr is None:
-                return None
-
-            ilvl_elem = numPr.find(qn('w:ilvl'))
-            numId_elem = numPr.find(qn('w:numId'))
-
-            if ilvl_elem is None or numId_elem is None:
-                return None
-
-            ilvl = ilvl_elem.get(qn('w:val'))
-            numId = numId_elem.get(qn('w:val'))
-
-            if numId in self.numbering_dict and ilvl in self.numbering_dict[numId]:
-                return {
-                    'numId': numId,
-                    'ilvl': int(ilvl),
-                    'format': self.numbering_dict[numId][ilvl]['format'],
-                    'text': self.numbering_dict[numId][ilvl]['text']
-                }
+            numbering_part = self.doc.part.numbering_part
+        except NotImplementedError:
+            numbering_part = None
+        if numbering_part is None:
+            return NumberingModel(self._empty('w:numbering'))
+        return _cached_model('numbering', numbering_part, NumberingModel)
 
-        except Exception as e:
-            print(f"Error getting numbering info: {e}")
+    def _parse_styles(self) -> StyleModel:
+        """Style definitions of the document (shared cache, keyed by part hash)"""
+        return _cached_model('styles', self.doc.part._styles_part, StyleModel)
 
-        return None
+    @staticmethod
+    def _empty(tag: str):
+        from docx.oxml import OxmlElement
+        return OxmlElement(tag)
 
-    def _format_number(self, counter: int, fmt: str) -> str:
-        """Format a counter based on numbering format"""
-        if fmt == 'decimal':
-            return str(counter)
-        elif fmt == 'upperRoman':
-            return self._to_roman(counter).upper()
-        elif fmt == 'lowerRoman':
-            return self._to_roman(counter).lower()
-        elif fmt == 'upperLetter':
-            return chr(64 + counter)  # A, B, C...
-        elif fmt == 'lowerLetter':
-            return chr(96 + counter)  # a, b, c...
-        elif fmt == 'bullet':
-            return '•'
-        else:
-            return str(counter)
-
-    def _to_roman(self, num: int) -> str:
-        """Convert number to Roman numerals"""
-        val = [1000, 900, 500, 400, 100, 90, 50, 40, 10, 9, 5, 4, 1]
-        syms = ['M', 'CM', 'D', 'CD', 'C', 'XC', 'L', 'XL', 'X', 'IX', 'V', 'IV', 'I']
-        result = ''
-        for i in range(len(val)):
-            count = int(num / val[i])
-            if count:
-                result += syms[i] * count
-                num -= val[i] * count
-        return result
+    def _get_numbering_info(self, paragraph):
+        """Extract numbering information from a paragraph (direct numPr, else via its style)"""
+        pPr = paragraph._element.pPr
+        style_id = pPr.style if pPr is not None else None
+        numPr = pPr.find(qn('w:numPr')) if pPr is not None else None
+
+        numId = _val(numPr, 'w:numId')
+        ilvl = _int(_val(numPr, 'w:ilvl'))
+        if numId is None or ilvl is None:
+            inherited = self.styles.numbering(style_id)
+            if inherited is not None:
+                numId = numId if numId is not None else inherited[0]
+                ilvl = ilvl if ilvl is not None else inherited[1]
+        if numId is None or numId == '0':
+            return None
+        ilvl = ilvl or 0
+
+        level = self.numbering.level(numId, ilvl)
+        if level is None:
+            return None
+        return {'numId': numId, 'ilvl': ilvl, 'format': level['format'], 'text': level['text']}
 
     def _get_paragraph_style(self, paragraph) -> str:
         """Get the style name of a paragraph"""
-        try:
-            return paragraph.style.name
-        except:
-            return 'Normal'
+        pPr = paragraph._element.pPr
+        return self.styles.name(pPr.style if pPr is not None else None)
+
+    def _blocks(self) -> list:
+        """Body-level paragraphs and tables, in document order"""
+        return list(self.doc.element.body.iterchildren(qn('w:p'), qn('w:tbl')))
+
+    def _render_paragraph(self, para, num_info: Optional[dict], marker: Optional[str]) -> str:
+        # Get paragraph text
+        text = html.escape(para.text)
+
+        if num_info:
+            # Add list item with proper indentation
+            indent = num_info['ilvl'] * 30
+            return (
+                f'<div class="list-item" style="margin-left: {indent}px;">'
+                f'<span class="list-marker">{html.escape(marker or "")}</span> {text}'
+                f'</div>'
+            )
+
+        # Determine paragraph style
+        style_name = self._get_paragraph_style(para)
+        if 'Heading' in style_name:
+            # Handle headings
+            level = 1
+            try:
+                level = int(style_name.split()[-1])
+            except:
+                level = 1
+            return f'<h{level}>{text}</h{level}>'
+
+        # Regular paragraph
+        if text.strip():
+            return f'<p>{text}</p>'
+        return '<p>&nbsp;</p>'
+
+    def _render_table(self, table) -> str:
+        html_parts = ['<table>']
+        for row in table.rows:
+            html_parts.append('<tr>')
+            for cell in row.cells:
+                cell_text = html.escape(cell.text)
+                html_parts.append(f'<td>{cell_text}</td>')
+            html_parts.append('</tr>')
+        html_parts.append('</table>')
+        return '\n'.join(html_parts)
+
+    def _next_marker(self, num_info: Optional[dict]) -> Optional[str]:
+        # Advance the list counters, then render the level text
+        if not num_info:
+            return None
+        self.list_counters.next(num_info['numId'], num_info['ilvl'])
+        return self.list_counters.marker(num_info['numId'], num_info['ilvl'])
 
     def convert_to_html(self) -> str:
         """Convert document to HTML with numbering"""
         html_parts = []
-
-        for para in self.doc.paragraphs:
-            # Check if paragraph is numbered
+        body = self.doc._body
+        for el in self._blocks():
+            if el.tag == qn('w:tbl'):
+                html_parts.append(self._render_table(Table(el, body)))
+                continue
+            para = Paragraph(el, body)
             num_info = self._get_numbering_info(para)
+            html_parts.append(self._render_paragraph(para, num_info, self._next_marker(num_info)))
+        return '\n'.join(html_parts)
 
-            # Get paragraph text
-            text = html.escape(para.text)
-
-            # Determine paragraph style
-            style_name = self._get_paragraph_style(para)
-
-            if num_info:
-                # Handle numbered/bulleted lists
-                ilvl = num_info['ilvl']
-                numId = num_info['numId']
-                fmt = num_info['format']
-
-                # Track counter for this list level
-                key = f"{numId}_{ilvl}"
-                if key not in self.list_counters:
-                    self.list_counters[key] = 1
-                else:
-                    self.list_counters[key] += 1
-
-                counter = self.list_counters[key]
-
-                # Format the number/bullet
-                if fmt == 'bullet':
-                    marker = '•'
-                    list_type = 'ul'
-                else:
-                    marker = self._format_number(counter, fmt) + '.'
-                    list_type = 'ol'
-
-                # Add list item with proper indentation
-                indent = ilvl * 30
-                html_parts.append(
-                    f'<div class="list-item" style="margin-left: {indent}px;">'
-                    f'<span class="list-marker">{marker}</span> {text}'
-                    f'</div>'
-                )
-
-            elif 'Heading' in style_name:
-                # Handle headings
-                level = 1
-                try:
-                    level = int(style_name.split()[-1])
-                except:
-                    level = 1
-                html_parts.append(f'<h{level}>{text}</h{level}>')
+    def build_block_index(self) -> List[list]:
+        """One compact entry per block: [kind, level, paragraph_id, ilvl, marker].
+
+        kind is "p" or "tbl"; paragraph_id matches the outline; ilvl/marker are
+        set for list items, with counters resolved over the whole document so
+        any window can be rendered without replaying the blocks before it.
+        """
+        index = []
+        p_index = 0
+        body = self.doc._body
+        for el in self._blocks():
+            if el.tag == qn('w:tbl'):
+                index.append(['tbl', 0, None, None, None])
+                continue
+            para = Paragraph(el, body)
+            level = style_heading_level(self._get_paragraph_style(para))
+            pid = stable_paragraph_id(para.text, p_index, level)
+            p_index += 1
+            num_info = self._get_numbering_info(para)
+            marker = self._next_marker(num_info)
+            index.append(['p', level, pid, num_info['ilvl'] if num_info else None, marker])
+        return index
 
+    def convert_window(self, index: List[list], start: int, end: int) -> str:
+        """Render blocks [start, end) using a block index from build_block_index()"""
+        html_parts = []
+        body = self.doc._body
+        blocks = self._blocks()
+        for i in range(max(0, start), min(end, len(blocks), len(index))):
+            el, entry = blocks[i], index[i]
+            if el.tag == qn('w:tbl'):
+                block_html = self._render_table(Table(el, body))
             else:
-                # Regular paragraph
-                if text.strip():
-                    html_parts.append(f'<p>{text}</p>')
-                else:
-                    html_parts.append('<p>&nbsp;</p>')
-
-        # Handle tables
-        for table in self.doc.tables:
-            html_parts.append('<table>')
-            for row in table.rows:
-                html_parts.append('<tr>')
-                for cell in row.cells:
-                    cell_text = html.escape(cell.text)
-                    html_parts.append(f'<td>{cell_text}</td>')
-                html_parts.append('</tr>')
-            html_parts.append('</table>')
-
+                num_info = {'ilvl': entry[3]} if entry[3] is not None else None
+                block_html = self._render_paragraph(Paragraph(el, body), num_info, entry[4])
+            html_parts.append(f'<div data-block="{i}">{block_html}</div>')
         return '\n'.join(html_parts)
 
 
@@ -200,3 +386,26 @@ def convert_docx_to_html(doc: Document) -> str:
     """Main function to convert DOCX to HTML with numbering"""
     converter = DocxToHtmlConverter(doc)
     return converter.convert_to_html()
+
+
+def build_block_index(doc: Document) -> List[list]:
+    return DocxToHtmlConverter(doc).build_block_index()
+
+
+def section_range(index: List[list], paragraph_id: str) -> Optional[Tuple[int, int]]:
+    """Block range of the section headed by `paragraph_id` (up to the next heading of the same or higher rank)"""
+    for start, entry in enumerate(index):
+        if entry[2] == paragraph_id:
+            level = entry[1]
+            if level == 0:
+                return start, start + 1
+            for end in range(start + 1, len(index)):
+                if 0 < index[end][1] <= level:
+                    return start, end
+            return start, len(index)
+    return None
+
+
+def convert_docx_window(doc: Document, index: List[list], start: int, end: int) -> str:
+    """HTML for blocks [start, end) only; cost scales with the window"""
+    return DocxToHtmlConverter(doc).convert_window(index, start, end)
@@ -0,0 +1,158 @@
+"""
+Full-text index over the paragraphs of every stored document (SQLite FTS5).
+
+Rows are refreshed per document from the outline that create/upload/apply
+already compute (only the paragraphs that changed are re-indexed), so search
+never has to open a .docx. Hits carry the paragraph_id, which can be used
+directly as after_paragraph_id.
+"""
+import os, json, difflib, sqlite3, threading
+from typing import List, Optional
+import storage
+
+INDEX_PATH = os.path.join(storage.STORAGE_DIR, "search.db")
+# matches scored per query (most recently indexed first)
+SEARCH_CANDIDATES = int(os.environ.get("SEARCH_CANDIDATES", "1000"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS paragraphs (
+    id INTEGER PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    paragraph_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    heading_path TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS paragraphs_file ON paragraphs(file_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS paragraphs_fts USING fts5(
+    text, heading_path, content='paragraphs', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS paragraphs_ai AFTER INSERT ON paragraphs BEGIN
+    INSERT INTO paragraphs_fts(rowid, text, heading_path) VALUES (new.id, new.text, new.heading_path);
+END;
+CREATE TRIGGER IF NOT EXISTS paragraphs_ad AFTER DELETE ON paragraphs BEGIN
+    INSERT INTO paragraphs_fts(paragraphs_fts, rowid, text, heading_path) VALUES ('delete', old.id, old.text, old.heading_path);
+END;
+"""
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+    conn = sqlite3.connect(INDEX_PATH, timeout=30)
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                _initialized = True
+    return conn
+
+
+def _rows(file_id: str, outline) -> List[tuple]:
+    # heading_path: texts of the enclosing headings, outermost first
+    stack: List[tuple] = []
+    rows = []
+    for pos, item in enumerate(outline):
+        level, text = item.level, item.text or ""
+        if level > 0:
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+        path = " > ".join(t for _, t in stack)
+        if level > 0:
+            stack.append((level, text))
+        if text.strip():
+            rows.append((file_id, item.paragraph_id, pos, level, path, text))
+    return rows
+
+
+def index_outline(file_id: str, outline) -> None:
+    """Bring the indexed paragraphs of one document in line with `outline`.
+
+    Stored rows are diffed against the new ones on (level, heading_path, text):
+    rows that only moved get paragraph_id/position updated in place, which
+    leaves the FTS content alone; only changed rows are deleted and inserted.
+    """
+    rows = _rows(file_id, outline)
+    conn = _connect()
+    try:
+        with conn:
+            old = conn.execute("SELECT id, paragraph_id, position, level, heading_path, text FROM paragraphs "
+                               "WHERE file_id = ? ORDER BY position", (file_id,)).fetchall()
+            deleted, moved, inserted = [], [], []
+            sm = difflib.SequenceMatcher(a=[r[3:] for r in old], b=[r[3:] for r in rows])
+            for opcode, i1, i2, j1, j2 in sm.get_opcodes():
+                if opcode == "equal":
+                    for o, n in zip(old[i1:i2], rows[j1:j2]):
+                        if o[1:3] != n[1:3]:
+                            moved.append((n[1], n[2], o[0]))
+                    continue
+                deleted.extend((o[0],) for o in old[i1:i2])
+                inserted.extend(rows[j1:j2])
+            conn.executemany("DELETE FROM paragraphs WHERE id = ?", deleted)
+            conn.executemany("UPDATE paragraphs SET paragraph_id = ?, position = ? WHERE id = ?", moved)
+            conn.executemany(
+                "INSERT INTO paragraphs(file_id, paragraph_id, position, level, heading_path, text) VALUES (?,?,?,?,?,?)",
+                inserted)
+    finally:
+        conn.close()
+
+
+def _match_expr(query: str) -> str:
+    # Plain text search: every whitespace-separated term must appear; FTS syntax is not exposed
+    terms = [t.replace('"', '""') for t in query.split()]
+    return " ".join(f'"{t}"' for t in terms)
+
+
+def search(query: str, file_id: Optional[str] = None, limit: int = 20) -> List[dict]:
+    """Best `limit` hits by bm25 among the SEARCH_CANDIDATES most recently indexed matches.
+
+    Ranking every match of a common term costs time proportional to the index,
+    so only a bounded candidate set is scored; snippets are built for the hits only.
+    """
+    expr = _match_expr(query)
+    if not expr:
+        return []
+    candidates = ("SELECT paragraphs_fts.rowid AS id, rank FROM paragraphs_fts "
+                  "JOIN paragraphs p ON p.id = paragraphs_fts.rowid WHERE paragraphs_fts MATCH :expr")
+    if file_id:
+        # the rowid range lets FTS5 skip other documents' matches instead of filtering them one by one
+        candidates += (" AND paragraphs_fts.rowid BETWEEN (SELECT min(id) FROM paragraphs WHERE file_id = :file_id)"
+                       " AND (SELECT max(id) FROM paragraphs WHERE file_id = :file_id) AND p.file_id = :file_id")
+    candidates += " ORDER BY paragraphs_fts.rowid DESC LIMIT :candidates"
+    sql = (f"WITH hits AS (SELECT id, rank FROM ({candidates}) ORDER BY rank LIMIT :limit) "
+           "SELECT p.file_id, p.paragraph_id, p.position, p.level, p.heading_path, "
+           "snippet(paragraphs_fts, 0, '[', ']', '…', 16) "
+           "FROM paragraphs_fts JOIN hits h ON h.id = paragraphs_fts.rowid JOIN paragraphs p ON p.id = h.id "
+           "WHERE paragraphs_fts MATCH :expr ORDER BY h.rank")
+    args = {"expr": expr, "file_id": file_id, "candidates": SEARCH_CANDIDATES, "limit": limit}
+    conn = _connect()
+    try:
+        return [
+            {"file_id": f, "paragraph_id": pid, "position": pos, "level": lvl, "heading_path": path, "snippet": snip}
+            for f, pid, pos, lvl, path, snip in conn.execute(sql, args)
+        ]
+    finally:
+        conn.close()
+
+
+def rebuild_index() -> int:
+    """Index every stored outline; for stores created before the index existed."""
+    from models import OutlineItem
+    count = 0
+    for fid in storage.document_ids():
+        try:
+            data = json.load(open(storage.outline_path(fid), "r", encoding="utf-8"))
+        except Exception:
+            continue
+        index_outline(fid, [OutlineItem(**x) for x in data])
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    print(f"indexed {rebuild_index()} documents")
@@ -0,0 +1,368 @@
+"""
+Storage layout and metadata catalog.
+
+Documents live in hash-prefix sharded directories,
+
+    STORAGE_DIR/docs/<aa>/<bb>/<file_id>/document.docx, outline.json, stats.json,
+                                          blocks.json, versions/vN.docx, vN.outline.json
+    STORAGE_DIR/redlines/<aa>/compare-<uuid>.docx
+    STORAGE_DIR/templates/<template_id>.docx
+
+and STORAGE_DIR/catalog.db (SQLite) holds documents, versions (with the
+operation log), head/redo pointers and redline outputs, so version numbering
+and lookups are indexed queries instead of directory scans.
+
+`python storage.py migrate` moves a flat pre-catalog store into this layout;
+`python storage.py gc` drops redline outputs older than REDLINE_TTL seconds.
+"""
+import os, re, json, time, shutil, sqlite3, hashlib, threading
+from typing import Dict, List, Optional, Tuple
+
+STORAGE_DIR = os.environ.get("STORAGE_DIR", os.path.join(os.path.dirname(__file__), "..", "storage"))
+os.makedirs(STORAGE_DIR, exist_ok=True)
+
+CATALOG_PATH = os.path.join(STORAGE_DIR, "catalog.db")
+DOCS_DIR = os.path.join(STORAGE_DIR, "docs")
+REDLINES_DIR = os.path.join(STORAGE_DIR, "redlines")
+TEMPLATES_DIR = os.path.join(STORAGE_DIR, "templates")
+REDLINE_TTL = int(os.environ.get("REDLINE_TTL", str(7 * 24 * 3600)))
+
+REDLINE_PREFIX = "compare-"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    file_id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    latest INTEGER NOT NULL DEFAULT 0,
+    head INTEGER NOT NULL DEFAULT 0,
+    redo TEXT NOT NULL DEFAULT '[]',
+    size INTEGER,
+    sha1 TEXT,
+    paragraphs INTEGER,
+    headings INTEGER,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS versions (
+    file_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    base INTEGER,
+    checkpoint INTEGER NOT NULL,
+    ops TEXT,
+    size INTEGER,
+    sha1 TEXT,
+    created REAL NOT NULL,
+    body_sha1 TEXT,
+    PRIMARY KEY (file_id, version)
+);
+CREATE TABLE IF NOT EXISTS redlines (
+    file_id TEXT PRIMARY KEY,
+    base_id TEXT,
+    revised_id TEXT,
+    size INTEGER,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS redlines_created ON redlines(created);
+"""
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+    conn = sqlite3.connect(CATALOG_PATH, timeout=30)
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                # catalogs created before versions.body_sha1
+                if "body_sha1" not in {r[1] for r in conn.execute("PRAGMA table_info(versions)")}:
+                    conn.execute("ALTER TABLE versions ADD COLUMN body_sha1 TEXT")
+                _initialized = True
+    return conn
+
+
+def _shard(key: str) -> Tuple[str, str]:
+    h = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return h[:2], h[2:4]
+
+
+# --------- Paths ---------
+def doc_dir(file_id: str) -> str:
+    a, b = _shard(file_id)
+    return os.path.join(DOCS_DIR, a, b, file_id)
+
+
+def redline_path(file_id: str) -> str:
+    return os.path.join(REDLINES_DIR, _shard(file_id)[0], f"{file_id}.docx")
+
+
+def file_path(file_id: str) -> str:
+    if file_id.startswith(REDLINE_PREFIX):
+        return redline_path(file_id)
+    return os.path.join(doc_dir(file_id), "document.docx")
+
+
+def outline_path(file_id: str) -> str:
+    return os.path.join(doc_dir(file_id), "outline.json")
+
+
+def stats_path(file_id: str) -> str:
+    return os.path.join(doc_dir(file_id), "stats.json")
+
+
+def blocks_path(file_id: str) -> str:
+    return os.path.join(doc_dir(file_id), "blocks.json")
+
+
+def versions_dir(file_id: str) -> str:
+    return os.path.join(doc_dir(file_id), "versions")
+
+
+def checkpoint_path(file_id: str, version: int) -> str:
+    return os.path.join(versions_dir(file_id), f"v{version}.docx")
+
+
+def version_outline_path(file_id: str, version: int) -> str:
+    return os.path.join(versions_dir(file_id), f"v{version}.outline.json")
+
+
+def template_path(template_id: str) -> str:
+    return os.path.join(TEMPLATES_DIR, f"{template_id}.docx")
+
+
+def ensure_doc_dir(file_id: str) -> str:
+    path = versions_dir(file_id)
+    os.makedirs(path, exist_ok=True)
+    return doc_dir(file_id)
+
+
+def file_digest(path: str) -> Tuple[int, str]:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return os.path.getsize(path), h.hexdigest()
+
+
+# --------- Documents & versions ---------
+_doc_locks: Dict[str, threading.RLock] = {}
+_doc_locks_guard = threading.Lock()
+
+
+def document_lock(file_id: str) -> threading.RLock:
+    """Per-document lock serializing writers (request handlers and background jobs)."""
+    with _doc_locks_guard:
+        lock = _doc_locks.get(file_id)
+        if lock is None:
+            lock = _doc_locks[file_id] = threading.RLock()
+        return lock
+
+
+def add_version(file_id: str, base: Optional[int], ops: Optional[list], checkpoint_every: int, src_path: str,
+                body_sha1: Optional[str] = None) -> Tuple[int, bool]:
+    """Allocate the next version number, record it and make it the head; returns (version, is_checkpoint).
+
+    `body_sha1` fingerprints the document body, so replays of `ops` can be checked.
+    """
+    size, sha1 = file_digest(src_path)
+    now = time.time()
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO documents(file_id, created, updated) VALUES (?,?,?)", (file_id, now, now))
+            (latest,) = conn.execute("SELECT latest FROM documents WHERE file_id = ?", (file_id,)).fetchone()
+            n = latest + 1
+            checkpoint = ops is None or n == 1 or n % checkpoint_every == 0
+            conn.execute(
+                "INSERT INTO versions(file_id, version, base, checkpoint, ops, size, sha1, created, body_sha1) VALUES (?,?,?,?,?,?,?,?,?)",
+                (file_id, n, base, int(checkpoint), json.dumps(ops, ensure_ascii=False) if ops is not None else None, size, sha1, now,
+                 body_sha1))
+            conn.execute("UPDATE documents SET latest = ?, head = ?, redo = '[]', updated = ?, size = ?, sha1 = ? WHERE file_id = ?",
+                         (n, n, now, size, sha1, file_id))
+        return n, checkpoint
+    finally:
+        conn.close()
+
+
+def _version_row(row) -> dict:
+    file_id, version, base, checkpoint, ops, size, sha1, created, body_sha1 = row
+    return {"version": version, "base": base, "checkpoint": bool(checkpoint),
+            "ops": json.loads(ops) if ops is not None else None, "size": size, "sha1": sha1, "ts": created,
+            "body_sha1": body_sha1}
+
+
+def get_version(file_id: str, version: int) -> Optional[dict]:
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT file_id, version, base, checkpoint, ops, size, sha1, created, body_sha1 FROM versions WHERE file_id = ? AND version = ?", (file_id, version)).fetchone()
+        return _version_row(row) if row else None
+    finally:
+        conn.close()
+
+
+def list_versions(file_id: str) -> List[dict]:
+    conn = _connect()
+    try:
+        return [_version_row(r) for r in conn.execute("SELECT file_id, version, base, checkpoint, ops, size, sha1, created, body_sha1 FROM versions WHERE file_id = ? ORDER BY version", (file_id,))]
+    finally:
+        conn.close()
+
+
+def get_head(file_id: str) -> Optional[Tuple[int, List[int]]]:
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT head, redo FROM documents WHERE file_id = ?", (file_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+    finally:
+        conn.close()
+
+
+def set_head(file_id: str, head: int, redo: List[int]) -> None:
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("UPDATE documents SET head = ?, redo = ?, updated = ? WHERE file_id = ?",
+                         (head, json.dumps(redo), time.time(), file_id))
+    finally:
+        conn.close()
+
+
+def update_outline_meta(file_id: str, outline) -> None:
+    title = next((o.text for o in outline if o.text and o.text.strip()), None)
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO documents(file_id, created, updated) VALUES (?,?,?)", (file_id, time.time(), time.time()))
+            conn.execute("UPDATE documents SET paragraphs = ?, headings = ?, title = ? WHERE file_id = ?",
+                         (len(outline), sum(1 for o in outline if o.level > 0), title, file_id))
+    finally:
+        conn.close()
+
+
+def document_ids() -> List[str]:
+    conn = _connect()
+    try:
+        return [r[0] for r in conn.execute("SELECT file_id FROM documents ORDER BY created")]
+    finally:
+        conn.close()
+
+
+# --------- Redline outputs ---------
+def register_redline(file_id: str, base_id: str, revised_id: str) -> None:
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO redlines(file_id, base_id, revised_id, size, created) VALUES (?,?,?,?,?)",
+                         (file_id, base_id, revised_id, os.path.getsize(redline_path(file_id)), time.time()))
+    finally:
+        conn.close()
+
+
+def gc_redlines(ttl: int = REDLINE_TTL) -> int:
+    """Delete redline outputs older than `ttl` seconds; returns how many were removed."""
+    cutoff = time.time() - ttl
+    conn = _connect()
+    try:
+        expired = [r[0] for r in conn.execute("SELECT file_id FROM redlines WHERE created < ?", (cutoff,))]
+        for fid in expired:
+            try:
+                os.remove(redline_path(fid))
+            except FileNotFoundError:
+                pass
+        with conn:
+            conn.executemany("DELETE FROM redlines WHERE file_id = ?", [(f,) for f in expired])
+        return len(expired)
+    finally:
+        conn.close()
+
+
+# --------- Migration from the flat layout ---------
+def _move(src: str, dst: str) -> None:
+    if os.path.exists(src):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(src, dst)
+
+
+def migrate_flat_store() -> Dict[str, int]:
+    """Move <id>.docx / <id>.outline.json / versions/<id>/ / compare-*.docx into the sharded layout, catalog and search index."""
+    moved = {"documents": 0, "redlines": 0}
+    legacy_versions = os.path.join(STORAGE_DIR, "versions")
+    for name in os.listdir(STORAGE_DIR):
+        if not name.endswith(".docx"):
+            continue
+        fid = name[:-len(".docx")]
+        src = os.path.join(STORAGE_DIR, name)
+        if fid.startswith(REDLINE_PREFIX):
+            created = os.path.getmtime(src)
+            _move(src, redline_path(fid))
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO redlines(file_id, size, created) VALUES (?,?,?)",
+                                 (fid, os.path.getsize(redline_path(fid)), created))
+            finally:
+                conn.close()
+            moved["redlines"] += 1
+            continue
+        _migrate_document(fid, legacy_versions)
+        moved["documents"] += 1
+    if os.path.isdir(legacy_versions) and not os.listdir(legacy_versions):
+        os.rmdir(legacy_versions)
+    return moved
+
+
+def _migrate_document(fid: str, legacy_versions: str) -> None:
+    # flat layout: <id>.docx, <id>.outline.json and full snapshots versions/<id>/vN.docx
+    created = os.path.getmtime(os.path.join(STORAGE_DIR, f"{fid}.docx"))
+    ensure_doc_dir(fid)
+    _move(os.path.join(STORAGE_DIR, f"{fid}.docx"), file_path(fid))
+    _move(os.path.join(STORAGE_DIR, f"{fid}.outline.json"), outline_path(fid))
+
+    snapshots: List[int] = []
+    vdir = os.path.join(legacy_versions, fid)
+    if os.path.isdir(vdir):
+        for name in os.listdir(vdir):
+            m = re.fullmatch(r"v(\d+)\.docx", name)
+            if m:
+                _move(os.path.join(vdir, name), checkpoint_path(fid, int(m.group(1))))
+                snapshots.append(int(m.group(1)))
+        shutil.rmtree(vdir, ignore_errors=True)
+    snapshots.sort()
+
+    now = time.time()
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO documents(file_id, created, updated) VALUES (?,?,?)", (fid, created, now))
+            base = None
+            for v in snapshots:
+                size, sha1 = file_digest(checkpoint_path(fid, v))
+                conn.execute(
+                    "INSERT OR REPLACE INTO versions(file_id, version, base, checkpoint, ops, size, sha1, created) VALUES (?,?,?,?,?,?,?,?)",
+                    (fid, v, base, 1, None, size, sha1, os.path.getmtime(checkpoint_path(fid, v))))
+                base = v
+            latest = snapshots[-1] if snapshots else 0
+            size, sha1 = file_digest(file_path(fid))
+            conn.execute("UPDATE documents SET latest = ?, head = ?, redo = '[]', size = ?, sha1 = ? WHERE file_id = ?",
+                         (latest, latest, size, sha1, fid))
+    finally:
+        conn.close()
+
+    # rewrite the outline (built from the .docx if the flat store had none), which also
+    # fills the catalog's outline columns and the search index; doc_ops imports storage
+    from doc_ops import load_outline, write_outline
+    write_outline(fid, load_outline(fid))
+
+
+if __name__ == "__main__":
+    import sys
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd == "migrate":
+        print(migrate_flat_store())
+    elif cmd == "gc":
+        print(f"removed {gc_redlines()} redline outputs")
+    else:
+        print("usage: python storage.py migrate|gc")
@@ -0,0 +1,121 @@
+"""
+Blank-document templates, parsed once and cloned per new document.
+
+`Document()` unzips and parses python-docx's bundled default.docx on every
+call. Here each template package is opened once; new documents get a fresh
+package whose XML parts are lxml copies of the cached trees and whose binary
+parts share the cached blobs, so there is no repeated template I/O or parsing.
+
+Custom templates (e.g. corporate letterheads, .docx or .dotx) are registered
+by id, stored (as .docx) under STORAGE_DIR/templates/ and usable from /api/create.
+"""
+import os, io, re, copy, zipfile, threading
+from typing import Dict, List, Optional
+from docx.document import Document as DocumentObject
+from docx.opc.constants import CONTENT_TYPE as CT
+from docx.opc.part import XmlPart
+from docx.package import Package
+import storage
+
+DEFAULT_TEMPLATE = "default"
+_DOTX_MAIN = "application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml"
+
+_TEMPLATE_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+_lock = threading.Lock()
+_packages: Dict[str, Package] = {}
+
+
+def _default_path() -> str:
+    import docx
+    return os.path.join(os.path.dirname(docx.__file__), "templates", "default.docx")
+
+
+def _open(source) -> Package:
+    package = Package.open(source)
+    ct = package.main_document_part.content_type
+    if ct != CT.WML_DOCUMENT_MAIN:
+        raise ValueError(f"not a Word document or template (content type '{ct}')")
+    return package
+
+
+def _as_document(data: bytes) -> bytes:
+    # a .dotx differs from a .docx only in the main part's content type
+    src = zipfile.ZipFile(io.BytesIO(data))
+    types = src.read("[Content_Types].xml")
+    if _DOTX_MAIN.encode() not in types:
+        return data
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as out:
+        for info in src.infolist():
+            blob = src.read(info)
+            if info.filename == "[Content_Types].xml":
+                blob = types.replace(_DOTX_MAIN.encode(), CT.WML_DOCUMENT_MAIN.encode())
+            out.writestr(info, blob)
+    return buf.getvalue()
+
+
+def _prototype(template_id: str) -> Package:
+    package = _packages.get(template_id)
+    if package is not None:
+        return package
+    with _lock:
+        package = _packages.get(template_id)
+        if package is None:
+            if template_id == DEFAULT_TEMPLATE:
+                path = _default_path()
+            else:
+                path = storage.template_path(template_id)
+                if not _TEMPLATE_ID.fullmatch(template_id) or not os.path.exists(path):
+                    raise FileNotFoundError(f"template {template_id} not found")
+            package = _packages[template_id] = _open(path)
+    return package
+
+
+def _clone(src: Package) -> Package:
+    # same steps as docx's Unmarshaller, but from already-parsed parts
+    package = Package()
+    parts = {}
+    for part in src.iter_parts():
+        cls = type(part)
+        if isinstance(part, XmlPart):
+            parts[part] = cls(part.partname, part.content_type, copy.deepcopy(part.element), package)
+        else:
+            parts[part] = cls.load(part.partname, part.content_type, part.blob, package)
+    for rel in src.rels.values():
+        package.load_rel(rel.reltype, rel.target_ref if rel.is_external else parts[rel.target_part], rel.rId, rel.is_external)
+    for part, new in parts.items():
+        for rel in part.rels.values():
+            new.load_rel(rel.reltype, rel.target_ref if rel.is_external else parts[rel.target_part], rel.rId, rel.is_external)
+    for new in parts.values():
+        new.after_unmarshal()
+    package.after_unmarshal()
+    return package
+
+
+def new_document(template_id: Optional[str] = None) -> DocumentObject:
+    """Fresh document from the cached template (python-docx's default when None)."""
+    return _clone(_prototype(template_id or DEFAULT_TEMPLATE)).main_document_part.document
+
+
+def register_template(template_id: str, data: bytes) -> None:
+    """Validate and store a custom template; replaces any template with the same id."""
+    if template_id == DEFAULT_TEMPLATE or not _TEMPLATE_ID.fullmatch(template_id):
+        raise ValueError("template_id must be 1-64 letters, digits, '-' or '_' and not 'default'")
+    try:
+        data = _as_document(data)
+        package = _open(io.BytesIO(data))
+    except (zipfile.BadZipFile, KeyError) as e:
+        raise ValueError(f"not a Word document or template: {e}")
+    os.makedirs(storage.TEMPLATES_DIR, exist_ok=True)
+    with open(storage.template_path(template_id), "wb") as f:
+        f.write(data)
+    with _lock:
+        _packages[template_id] = package
+
+
+def list_templates() -> List[str]:
+    if not os.path.isdir(storage.TEMPLATES_DIR):
+        return [DEFAULT_TEMPLATE]
+    custom = sorted(n[:-len(".docx")] for n in os.listdir(storage.TEMPLATES_DIR) if n.endswith(".docx"))
+    return [DEFAULT_TEMPLATE] + custom
@@ -12,3 +12,32 @@ def stable_paragraph_id(text: str, index: int, heading_level: int) -> str:
     h = hashlib.sha1(payload.encode("utf-8")).hexdigest()[:10]
     prefix = f"h{heading_level}" if heading_level>0 else "p"
     return f"{prefix}-{h}"
+
+def text_hash(text: str) -> str:
+    # Content hash exchanged with the Word add-in for anchor reconciliation
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()[:16]
+
+def style_heading_level(style_name: str) -> int:
+    # 0 for body styles, 1..6 from a "Heading N" style name
+    name = (style_name or "").lower()
+    if name.startswith("heading"):
+        try:
+            parts = name.split()
+            lvl = int(parts[1]) if len(parts)>1 else 1
+            return max(1, min(6, lvl))
+        except Exception:
+            return 1
+    return 0
+
+def heading_level(p) -> int:
+    try:
+        name = p.style.name
+    except Exception:
+        name = ""
+    return style_heading_level(name)
+
+def style_level(p, heading_styles: dict) -> int:
+    # Same result as heading_level(p) from a {style_id: level} map, without resolving p.style
+    pPr = p._p.pPr
+    style_id = pPr.style if pPr is not None else None
+    return heading_styles.get(style_id, 0)
@@ -23,3 +23,41 @@ export interface OutlineItem {
   text: string
   level: number // 0 for body, 1..6 for headings
 }
+
+// Columnar outline (format=columns): parallel arrays, one entry per paragraph
+export interface OutlineColumns {
+  format: "columns"
+  length: number
+  paragraph_id: string[]
+  level: number[]
+  text: string[]
+  text_length?: number[] // full text lengths, present when text_limit truncated the texts
+}
+
+export function fromColumns(cols: OutlineColumns): OutlineItem[] {
+  const items: OutlineItem[] = new Array(cols.length)
+  for (let i = 0; i < cols.length; i++) {
+    items[i] = { paragraph_id: cols.paragraph_id[i], text: cols.text[i], level: cols.level[i] }
+  }
+  return items
+}
+
+export interface OutlineDelta {
+  from_version: number
+  to_version: number
+  length: number
+  removed: { index: number, paragraph_id: string }[]  // indices into the old outline
+  inserted: (OutlineItem & { index: number })[]       // indices into the new outline
+  updated: (Partial<OutlineItem> & { index: number })[]
+  // paragraphs that only moved: their IDs in [reindex_from, reindex_to) are recomputed with paragraphId
+  reindex_from: number | null
+  reindex_to: number | null
+}
+
+// Same scheme as backend utils.stable_paragraph_id; needs the full (not text_limit-truncated) text
+export async function paragraphId(text: string, level: number, index: number): Promise<string> {
+  const norm = (text || '').trim().replace(/\s+/g, ' ')
+  const buf = await crypto.subtle.digest('SHA-1', new TextEncoder().encode(`${norm}|${level}|${index}`))
+  const hex = Array.from(new Uint8Array(buf)).map(b => b.toString(16).padStart(2, '0')).join('')
+  return (level > 0 ? 'h' + level : 'p') + '-' + hex.slice(0, 10)
+}
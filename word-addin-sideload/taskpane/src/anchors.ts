@@ -1,38 +1,84 @@
 import type { OutlineItem } from './types'
 
+const ANCHOR_TITLE = 'anchor:'
+
 function normalize(s: string){ return (s||'').trim().replace(/\s+/g,' ') }
-function hash(s: string){ let h=0; for(let i=0;i<s.length;i++){ h=((h<<5)-h)+s.charCodeAt(i); h|=0 } return (h>>>0).toString(16).slice(0,8) }
+async function sha1(s: string){
+  const buf = await crypto.subtle.digest('SHA-1', new TextEncoder().encode(s))
+  return Array.from(new Uint8Array(buf)).map(b => b.toString(16).padStart(2,'0')).join('')
+}
+// Same scheme as backend utils.stable_paragraph_id / utils.text_hash
+async function paragraphId(text: string, lvl: number, i: number){ return (lvl>0?'h'+lvl:'p') + '-' + (await sha1(text + '|' + lvl + '|' + i)).slice(0,10) }
+async function textHash(text: string){ return (await sha1(text)).slice(0,16) }
+// Same rule as backend utils.style_heading_level: "Heading N" (styleBuiltIn spells it "HeadingN"), clamped to 1..6
 function lvlFromStyle(name?: string): number {
-  const n=(name||'').toLowerCase()
-  if(n.includes('heading 1')) return 1
-  if(n.includes('heading 2')) return 2
-  if(n.includes('heading 3')) return 3
-  if(n.includes('heading 4')) return 4
-  if(n.includes('heading 5')) return 5
-  if(n.includes('heading 6')) return 6
-  return 0
+  const m = /^heading\s*(\d+)?/i.exec((name||'').trim())
+  if(!m) return 0
+  return m[1] ? Math.max(1, Math.min(6, parseInt(m[1], 10))) : 1
+}
+// styleBuiltIn is "Other" for custom styles; fall back to the style name then
+function styleOf(p: Word.Paragraph): string {
+  const builtIn = (p as any).styleBuiltIn as string | undefined
+  return builtIn && builtIn !== 'Other' ? builtIn : (p.style || '')
+}
+
+export interface BackendDoc { baseUrl: string; fileId: string }
+
+interface Reconciled { ids: (string|null)[]; add: [number, string][]; drop: string[] }
+
+async function reconcile(backend: BackendDoc, texts: string[], levels: number[], anchors: string[]): Promise<Reconciled> {
+  const paragraphs = await Promise.all(texts.map(async (t, i) => [i, await textHash(t), levels[i]]))
+  const resp = await fetch(backend.baseUrl.replace(/\/$/,'') + '/api/anchors/reconcile', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ file_id: backend.fileId, paragraphs, anchors })
+  })
+  if(!resp.ok) throw new Error('reconcile failed: ' + resp.status)
+  return resp.json()
 }
 
-export async function buildOutline(): Promise<OutlineItem[]> {
+// Tags every paragraph with an anchor content control. Paragraphs and existing
+// anchors are read in one sync and all adds/drops go out in a second one. With
+// `backend`, IDs are the stored document's paragraph_ids (matched by content),
+// so backend plans can target them directly.
+export async function buildOutline(backend?: BackendDoc): Promise<OutlineItem[]> {
   return Word.run(async (context) => {
     const paras = context.document.body.paragraphs
-    paras.load('items/text,items/style,items/styleBuiltIn')
+    paras.load('items/text,items/style,items/styleBuiltIn,items/tableNestingLevel')
+    const ccs = context.document.contentControls
+    ccs.load('items/tag,items/title')
     await context.sync()
-    const out: OutlineItem[] = []
-    for (let i=0;i<paras.items.length;i++){
-      const p = paras.items[i] as any
-      const text = normalize(p.text || '')
-      const lvl  = lvlFromStyle(p.styleBuiltIn || p.style || '')
-      const pid  = (lvl>0?'h'+lvl:'p') + '-' + hash(text + '|' + lvl + '|' + i)
-      out.push({ paragraph_id: pid, text, level: lvl })
-
-      // anchor via content control tag
-      const r = paras.items[i].getRange()
-      const ccs = r.contentControls; ccs.load('items/tag'); await context.sync()
-      let has=false; for(const cc of ccs.items){ if(cc.tag===pid){ has=true; break } }
-      if(!has){ const cc = r.insertContentControl(); cc.tag = pid; cc.title = 'anchor:'+pid }
+
+    // the backend's paragraph indices (doc.paragraphs) skip paragraphs inside tables
+    const body = paras.items.filter(p => p.tableNestingLevel === 0)
+    const texts = body.map(p => normalize(p.text || ''))
+    const levels = body.map(p => lvlFromStyle(styleOf(p)))
+    const anchorCcs = ccs.items.filter(cc => (cc.title || '').startsWith(ANCHOR_TITLE))
+    const present = anchorCcs.map(cc => cc.tag)
+
+    let plan: Reconciled
+    if(backend){
+      plan = await reconcile(backend, texts, levels, present)
+    } else {
+      const ids = await Promise.all(texts.map((t, i) => paragraphId(t, levels[i], i)))
+      const have = new Set(present), wanted = new Set(ids)
+      plan = {
+        ids,
+        add: ids.map((pid, i) => [i, pid] as [number, string]).filter(([, pid]) => !have.has(pid)),
+        drop: present.filter(tag => !wanted.has(tag))
+      }
+    }
+
+    const drop = new Set(plan.drop)
+    for(const cc of anchorCcs){ if(drop.has(cc.tag)) cc.delete(true) }
+    for(const [i, pid] of plan.add){
+      const cc = body[i].getRange().insertContentControl()
+      cc.tag = pid; cc.title = ANCHOR_TITLE + pid
     }
     await context.sync()
+
+    const out: OutlineItem[] = []
+    plan.ids.forEach((pid, i) => { if(pid) out.push({ paragraph_id: pid, text: texts[i], level: levels[i] }) })
     Office.context.document.settings.set('anchorOutline', out)
     Office.context.document.settings.saveAsync()
     return out